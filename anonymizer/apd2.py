@@ -1,7 +1,8 @@
-from utils.cross_correlation import crosscorr_2d, crosscorr_2d_color
+from utils.cross_correlation import crosscorr_2d, crosscorr_2d_color, fingerprint_spectrum, LinearCrossCorrelation
 from utils.constants import BASEPATH, OUTPUTPATH, FINGERPRINTSPATH_ANONYMIZATION
 from utils.pce import pce, pce_color
-from utils.rotate_image import rotate_image, rotate_back_image
+from utils.rotate_image import imread_aligned, rotate_back_image, prefetch_orientations
+from utils.fingerprint_store import load_fingerprint
 import numpy as np
 import os
 from math import log10
@@ -10,6 +11,10 @@ import glob
 import pywt
 import cv2
 
+# Caps of the strength search of anonymize_image
+MAX_EVALUATIONS = 40
+MAX_STRENGTH = 4.0
+
 def wavelet_denoise(image, wavelet='db8', level=4):
     coeffs = pywt.wavedec2(image, wavelet, level=level)
     coeffs_thresholded = [coeffs[0]] + [(pywt.threshold(cH, np.std(cH), mode='soft'),
@@ -27,25 +32,70 @@ def wavelet_denoise_rgb(image, wavelet='db8', level=4):
     
     return np.stack(denoised_channels, axis=2)
 
-def anonymize_image(image, prnu_estimate, threshold=50):
-    b = 0.0
-    res_pce = 0
-    while True:
-        noise = image - wavelet_denoise_rgb(image)
-        anonymized = image - (log10(b+1) + 0.00001) * noise
-        # anonymized = image - (0.0001 * 1.2**b) * noise
-        res_pce = pce_color(crosscorr_2d_color(anonymized, prnu_estimate))
-        if res_pce < threshold:
-            print('pce: ',res_pce,', b: ', b)
-            return anonymized
-        b += 1
+def apd2_strength(b):
+    return log10(b + 1) + 0.00001
+
+def anonymize_image(image, prnu_estimate, threshold=50, max_evaluations=MAX_EVALUATIONS, max_strength=MAX_STRENGTH):
+    """
+    Subtract from the image its noise, scaled by apd2_strength(b) for the smallest integer b bringing the PCE
+    below threshold. Assuming the PCE decreases with the strength, b is bracketed with exponential steps
+    (0, 1, 3, 7, ...) and then bisected, instead of trying b = 0, 1, 2, ... in turn
+    :param image: 3D matrix (H, W, C), properly oriented
+    :param prnu_estimate: fingerprint, or its FingerprintSpectrum
+    :param threshold: PCE to be reached
+    :param max_evaluations: maximum number of PCE evaluations
+    :param max_strength: maximum strength, i.e. b is at most 10 ** max_strength - 1
+    :return: (anonymized image, number of PCE evaluations). If the threshold is not reached within the caps,
+             the image is anonymized with the evaluated strength giving the lowest PCE
+    """
+    noise = image - wavelet_denoise_rgb(image)
+    # Every candidate is image - strength * noise: correlate image and noise once
+    correlation = LinearCrossCorrelation(image, noise, prnu_estimate)
+    b_max = max(0, int(10 ** max_strength) - 1)
+
+    pces = {}
+    def evaluate(b):
+        if b not in pces:
+            pces[b] = correlation.pce(apd2_strength(b))
+        return pces[b]
+
+    # Bracket: b_above is the largest b known above threshold, b_below the smallest known below
+    b_above, b_below = None, None
+    b = 0
+    while len(pces) < max_evaluations:
+        if evaluate(b) < threshold:
+            b_below = b
+            break
+        b_above = b
+        if b == b_max:
+            break
+        b = min(2 * b + 1, b_max)
+
+    if b_below is None:
+        b = min(pces, key=pces.get)
+        print('threshold not reached, pce: ', pces[b], ', b: ', b, ', evaluations: ', len(pces))
+        return image - apd2_strength(b) * noise, len(pces)
+
+    # Bisection of the bracket
+    while b_above is not None and b_below - b_above > 1 and len(pces) < max_evaluations:
+        b = (b_above + b_below) // 2
+        if evaluate(b) < threshold:
+            b_below = b
+        else:
+            b_above = b
+
+    print('pce: ', pces[b_below], ', b: ', b_below, ', evaluations: ', len(pces))
+    return image - apd2_strength(b_below) * noise, len(pces)
 
     
 def main(chosen_devices: list):
     for device in chosen_devices:
         files = sorted(glob.glob(BASEPATH + 'D' + device +'/nat/*.*'))
-        fingerprint = np.load(FINGERPRINTSPATH_ANONYMIZATION + 'Fingerprint_D' + device + '.npy').astype(np.float32)
-        fingerprint = np.repeat(fingerprint[..., np.newaxis], 3, axis=2)
+        prefetch_orientations(files)
+        fingerprint_file = FINGERPRINTSPATH_ANONYMIZATION + 'Fingerprint_D' + device + '.npy'
+        fingerprint = load_fingerprint(FINGERPRINTSPATH_ANONYMIZATION, 'D' + device)
+        # Transform the fingerprint once, every iteration only needs the FFT of the image
+        fingerprint = fingerprint_spectrum(fingerprint, device=fingerprint_file)
         output_folder = OUTPUTPATH + 'apd2/D' + device + '/'
 
         if not os.path.exists(output_folder):
@@ -54,13 +104,13 @@ def main(chosen_devices: list):
         for file in files:
             print('anonymizing file: ', file)
             file_name = file.split("/")[-1]
-            image = cv2.imread(file).astype(np.float32)
-            image = rotate_image(image, file)
+            image = imread_aligned(file)
             if image is None:
                 continue
+            image = image.astype(np.float32)
 
 
             print('original pce: ',pce_color(crosscorr_2d_color(image, fingerprint)))
-            anonymized_image = anonymize_image(image, fingerprint)
+            anonymized_image, _ = anonymize_image(image, fingerprint)
             cv2.imwrite(output_folder+file_name, rotate_back_image(anonymized_image,file),[cv2.IMWRITE_JPEG_QUALITY, 100])
             # cv2.imwrite(output_folder+"Gray_"+file_name, rotate_back_image(image,file),[cv2.IMWRITE_JPEG_QUALITY, 100])
@@ -1,6 +1,8 @@
 from utils.constants import BASEPATH, OUTPUTPATH, FINGERPRINTSPATH_ANONYMIZATION_K1, FINGERPRINTSPATH_ANONYMIZATION_K2
-from utils.rotate_image import rotate_image, rotate_back_image
-from utils.cross_correlation import crosscorr_2d_color
+from utils.rotate_image import imread_aligned, rotate_back_image, prefetch_orientations
+from utils.fingerprint_store import load_fingerprint
+from utils.fft_backend import rfft, irfft
+from utils.cross_correlation import crosscorr_2d_color, fingerprint_spectrum, FingerprintSpectrum, LinearCrossCorrelation
 from skimage.restoration import denoise_wavelet
 from utils.pce import pce_color
 import numpy as np
@@ -13,6 +15,9 @@ def main(devices_list: list[str]):
     alpha_max = 1.0
     threshold_T = 1
     max_iters = 10
+    # Alphas evaluated per round and number of rounds, grid_size = None for the sequential bisection
+    grid_size = 8
+    max_rounds = 3
 
     devices = sorted(glob.glob(BASEPATH+'D*'))
 
@@ -20,23 +25,27 @@ def main(devices_list: list[str]):
         if device_path[-2:] not in devices_list:
             continue
         files = sorted(glob.glob(device_path + '/nat/*.*'))
+        prefetch_orientations(files)
         output_folder = OUTPUTPATH + 'fingerprint_removal/D' + device_path[-2:] + '/'
         fingerprints_file_k1 = FINGERPRINTSPATH_ANONYMIZATION_K1 + 'Fingerprint_D' + device_path[-2:] + '.npy'
         fingerprints_file_k2 = FINGERPRINTSPATH_ANONYMIZATION_K2 + 'Fingerprint_D' + device_path[-2:] + '.npy'
         try:
-            estimated_fingerprint_k1 = np.load(fingerprints_file_k1)
-            estimated_fingerprint_k2 = np.load(fingerprints_file_k2)
+            estimated_fingerprint_k1 = load_fingerprint(FINGERPRINTSPATH_ANONYMIZATION_K1, 'D' + device_path[-2:])
+            estimated_fingerprint_k2 = load_fingerprint(FINGERPRINTSPATH_ANONYMIZATION_K2, 'D' + device_path[-2:])
         except FileNotFoundError:
             print(f"Fingerprint files not found for device {device_path[-2:]}. Skipping...")
             continue
+        # Transform the fingerprints once per device instead of at every correlation
+        estimated_fingerprint_k1 = fingerprint_spectrum(estimated_fingerprint_k1, device=fingerprints_file_k1)
+        estimated_fingerprint_k2 = fingerprint_spectrum(estimated_fingerprint_k2, device=fingerprints_file_k2)
         for img_name in files:
             # Load 'original_image' and estimated fingerprints as NumPy arrays.
             print(f"[ANONYMIZING fingerprint_removal] {img_name}")
             # original_image = cv2.imread(img_name, cv2.IMREAD_GRAYSCALE).astype(np.float32)
-            original_image = cv2.imread(img_name).astype(np.float32)
-            original_image = rotate_image(original_image, img_name)
+            original_image = imread_aligned(img_name)
             if original_image is None:
                 continue
+            original_image = original_image.astype(np.float32)
 
             altered = remove_camera_fingerprint(
                 original_image,
@@ -45,7 +54,9 @@ def main(devices_list: list[str]):
                 alpha_min,
                 alpha_max,
                 threshold_T,
-                max_iters
+                max_iters,
+                grid_size,
+                max_rounds
             )
             if altered is None:
                 altered = original_image
@@ -132,9 +143,9 @@ def ccn_paper(x, y, neighbors=30):
     
     # Compute circular cross-correlation using FFT
     # (r_xy(m) = IFFT( FFT(x) * conj(FFT(y)) )[m], normalized by L)
-    X = np.fft.fft(x)
-    Y = np.fft.fft(y)
-    cc = np.fft.ifft(X * np.conj(Y)).real    # shape (L,)
+    X = rfft(x)
+    Y = rfft(y)
+    cc = irfft(X * np.conj(Y), n=L)    # shape (L,)
     cc /= L  # so that r_xy(m) = (1/L)*Σ x_i y_{(i+m)%L}
 
     # r_xy(0) is the main correlation at zero lag
@@ -151,6 +162,110 @@ def ccn_paper(x, y, neighbors=30):
     # Finally c(x, y) = r_xy(0) / denom
     return r0 / denom
 
+def bisect_alpha(correlation_metric, alpha_min, alpha_max, T, max_iterations):
+    """
+    Sequential search of the strength alpha, halving [alpha_min, alpha_max] toward its lower PCE end
+    :param correlation_metric: PCE of an alpha
+    :param alpha_min: initial minimum strength
+    :param alpha_max: initial maximum strength
+    :param T: PCE threshold
+    :param max_iterations: maximum number of iterations
+    :return: (best alpha, True if it lowers the PCE of the unaltered image)
+    """
+    # Initialize
+    best_alpha = 0.0
+    best_corr = correlation_metric(best_alpha)
+    print(f"Best corr: {best_corr}")
+
+    changed_max = False
+    changed_min = False
+    corr_max = correlation_metric(alpha_max)
+    corr_min = correlation_metric(alpha_min)
+    modified = False
+
+    # Iteratively search for alpha
+    for _ in range(max_iterations):
+        # Candidate with alpha_max
+        if changed_max:
+            corr_max = correlation_metric(alpha_max)
+            changed_max = False
+        print(f"corr_max: {corr_max}")
+
+        if corr_max < T:
+            best_alpha = alpha_max
+            modified = True
+            break  # We've satisfied the threshold
+
+        # Candidate with alpha_min
+        if changed_min:
+            corr_min = correlation_metric(alpha_min)
+            changed_min = False
+        print(f"corr_min: {corr_min}")
+
+        if corr_min < T:
+            best_alpha = alpha_min
+            modified = True
+            break  # We've satisfied the threshold
+
+        # Decide which side to shrink based on which correlation is lower
+        if corr_min < corr_max:
+            # We lean toward alpha_min
+            changed_max = True
+            alpha_max = 0.5 * (alpha_min + alpha_max)
+            if corr_min < best_corr:
+                best_alpha = alpha_min
+                best_corr = corr_min
+                modified = True
+        else:
+            # We lean toward alpha_max
+            changed_min = True
+            alpha_min = 0.5 * (alpha_min + alpha_max)
+            if corr_max < best_corr:
+                best_alpha = alpha_max
+                best_corr = corr_max
+                modified = True
+
+    return best_alpha, modified
+
+def grid_search_alpha(correlation, alpha_min, alpha_max, T, max_rounds, grid_size, threads=None):
+    """
+    Search of the strength alpha by rounds: each round scores a grid of grid_size alphas in [alpha_min, alpha_max]
+    as one batch. The smallest alpha of the grid below T is returned, otherwise the grid is narrowed around
+    the alpha with the lowest PCE
+    :param correlation: LinearCrossCorrelation of J and J * K1 with K2
+    :param alpha_min: initial minimum strength
+    :param alpha_max: initial maximum strength
+    :param T: PCE threshold
+    :param max_rounds: maximum number of rounds
+    :param grid_size: number of alphas per round, at least 3
+    :param threads: threads scoring the grid, as in LinearCrossCorrelation.pce_batch
+    :return: (best alpha, True if it lowers the PCE of the unaltered image)
+    """
+    assert grid_size >= 3, "The grid needs at least 3 alphas."
+    best_alpha = 0.0
+    best_corr = correlation.pce(best_alpha)
+    print(f"Best corr: {best_corr}")
+    modified = False
+
+    for _ in range(max_rounds):
+        alphas = np.linspace(alpha_min, alpha_max, grid_size)
+        corrs = correlation.pce_batch(alphas, threads=threads)
+        print(f"alphas: [{alpha_min}, {alpha_max}], min corr: {corrs.min()}")
+
+        below = np.flatnonzero(corrs < T)
+        if below.size:
+            return float(alphas[below[0]]), True
+
+        idx = int(np.argmin(corrs))
+        if corrs[idx] < best_corr:
+            best_alpha = float(alphas[idx])
+            best_corr = corrs[idx]
+            modified = True
+        alpha_min = alphas[max(idx - 1, 0)]
+        alpha_max = alphas[min(idx + 1, grid_size - 1)]
+
+    return best_alpha, modified
+
 def remove_camera_fingerprint(
     image: np.ndarray,
     fingerprint_k1: np.ndarray,
@@ -158,7 +273,9 @@ def remove_camera_fingerprint(
     alpha_min: float,
     alpha_max: float,
     T: float,
-    max_iterations: int
+    max_iterations: int,
+    grid_size: int = None,
+    max_rounds: int = 3
 ) -> np.ndarray:
     """
     Implements the PRNU (camera fingerprint) removal attack as described
@@ -170,10 +287,10 @@ def remove_camera_fingerprint(
     -----------
     image         : np.ndarray
         The original (unaltered) input image, shape (H, W) or (H, W, C).
-    fingerprint_k1: np.ndarray
+    fingerprint_k1: np.ndarray or FingerprintSpectrum
         The estimated PRNU fingerprint for the camera, with some images. Must match
         the shape of the image or be broadcastable.
-    fingerprint_k2: np.ndarray
+    fingerprint_k2: np.ndarray or FingerprintSpectrum
         The estimated PRNU fingerprint for the camera, with other images. Must match
         the shape of the image or be broadcastable.
     alpha_min     : float
@@ -184,7 +301,12 @@ def remove_camera_fingerprint(
         The absolute correlation threshold below which we say
         "the fingerprint is removed".
     max_iterations: int
-        The maximum number of iterations to try before stopping.
+        The maximum number of iterations of the bisection before stopping.
+    grid_size     : int
+        If given, evaluate grid_size alphas per round with grid_search_alpha
+        instead of bisecting the range one alpha at a time.
+    max_rounds    : int
+        The maximum number of rounds of the grid search.
 
     Returns:
     --------
@@ -195,15 +317,23 @@ def remove_camera_fingerprint(
     """
     # Copy the input so as not to overwrite
     J = image.astype(np.float32).copy()
-    if image.ndim == 3 and fingerprint_k1.ndim == 2:
-        fingerprint_k1 = np.repeat(fingerprint_k1[..., np.newaxis], 3, axis=2)
-    if image.ndim == 3 and fingerprint_k2.ndim == 2:
-        fingerprint_k2 = np.repeat(fingerprint_k2[..., np.newaxis], 3, axis=2)
-    K1 = fingerprint_k1.astype(np.float32)
-    K2 = fingerprint_k2.astype(np.float32)
-
-    # A helper to compute the correlation c(x(J'), J'*K) from the paper.
-    def correlation_metric(J_prime):
+    if not isinstance(fingerprint_k1, FingerprintSpectrum):
+        fingerprint_k1 = fingerprint_spectrum(fingerprint_k1.astype(np.float32))
+    if not isinstance(fingerprint_k2, FingerprintSpectrum):
+        fingerprint_k2 = fingerprint_spectrum(fingerprint_k2.astype(np.float32))
+    K1 = fingerprint_k1.fingerprint.astype(np.float32, copy=False)
+    # A grayscale fingerprint multiplies every channel of the image
+    if image.ndim == 3 and K1.ndim == 2:
+        K1 = K1[..., np.newaxis]
+    K2 = fingerprint_k2
+
+    # J * (1 - alpha * K1) = J - alpha * (J * K1): correlate J and J * K1 once,
+    # then every alpha is evaluated without computing the altered image
+    correlation = LinearCrossCorrelation(J, J * K1, K2)
+
+    # A helper to compute the correlation c(x(J'), J'*K) from the paper,
+    # with J' = J * (1 - alpha * K1).
+    def correlation_metric(alpha):
         """
         Computes abs( c( x(J'), J'*K ) ),
         where x(J') is the noise residual of J',
@@ -219,67 +349,17 @@ def remove_camera_fingerprint(
         ccnfft = ccn_paper(x_Jp, product)
         return abs(ccnfft)
         """
-        return pce_color(crosscorr_2d_color(J_prime, K2))
-
-    # Initialize
-    best_image = J.copy()
-    best_corr = correlation_metric(best_image)
-    print(f"Best corr: {best_corr}")
-
-    changed_max = False
-    changed_min = False
-    J_max = J * (1.0 - alpha_max * K1)
-    J_min = J * (1.0 - alpha_min * K1)
-    corr_max = correlation_metric(J_max)
-    corr_min = correlation_metric(J_min)
-    modified = False
-
-    # Iteratively search for alpha
-    for _ in range(max_iterations):
-        # Candidate with alpha_max
-        if changed_max:
-            J_max = J * (1.0 - alpha_max * K1)
-            corr_max = correlation_metric(J_max)
-            changed_max = False
-        print(f"corr_max: {corr_max}")
-
-        if corr_max < T:
-            best_image = J_max
-            modified = True
-            break  # We've satisfied the threshold
+        return correlation.pce(alpha)
 
-        # Candidate with alpha_min
-        if changed_min:
-            J_min = J * (1.0 - alpha_min * K1)
-            corr_min = correlation_metric(J_min)
-            changed_min = False
-        print(f"corr_min: {corr_min}")
-
-        if corr_min < T:
-            best_image = J_min
-            modified = True
-            break  # We've satisfied the threshold
+    if grid_size is None:
+        best_alpha, modified = bisect_alpha(correlation_metric, alpha_min, alpha_max, T, max_iterations)
+    else:
+        best_alpha, modified = grid_search_alpha(correlation, alpha_min, alpha_max, T, max_rounds, grid_size)
 
-        # Decide which side to shrink based on which correlation is lower
-        if corr_min < corr_max:
-            # We lean toward alpha_min
-            changed_max = True
-            alpha_max = 0.5 * (alpha_min + alpha_max)
-            if corr_min < best_corr:
-                best_image = J_min
-                best_corr = corr_min
-                modified = True
-        else:
-            # We lean toward alpha_max
-            changed_min = True
-            alpha_min = 0.5 * (alpha_min + alpha_max)
-            if corr_max < best_corr:
-                best_image = J_max
-                best_corr = corr_max
-                modified = True
+    best_image = J * (1.0 - best_alpha * K1)
 
     print(f"Pce k1 dopo: {pce_color(crosscorr_2d_color(best_image, fingerprint_k1))}")
-    print(f"Pce k2 dopo: {pce_color(crosscorr_2d_color(best_image, fingerprint_k2))}")
+    print(f"Pce k2 dopo: {correlation_metric(best_alpha)}")
 
     if not modified:
         return None
@@ -1,7 +1,7 @@
-from utils.cross_correlation import crosscorr_2d, crosscorr_2d_color
+from utils.cross_correlation import fingerprint_spectrum, LinearCrossCorrelation
 from utils.constants import OUTPUTPATH, BASEPATH, FINGERPRINTSPATH_ANONYMIZATION
-from utils.rotate_image import rotate_image, rotate_back_image
-from utils.pce import pce, pce_color
+from utils.rotate_image import imread_aligned, rotate_back_image, prefetch_orientations
+from utils.fingerprint_store import load_fingerprint
 import numpy as np
 import glob
 import cv2
@@ -25,30 +25,37 @@ def main(devices: list[str]) -> None:
     for device in devices:
         # Cache fingerprint for the device (load it once)
         device_fingerprint_file = os.path.join(fingerprint_base+f"{device}.npy")
-        fingerprint = np.load(device_fingerprint_file)
-        fingerprint = np.repeat(fingerprint[..., np.newaxis], 3, axis=2)
+        fingerprint = load_fingerprint(FINGERPRINTSPATH_ANONYMIZATION, 'D' + device)
+        fingerprint = fingerprint_spectrum(fingerprint, device=device_fingerprint_file)
 
         # Create device save folder if it does not exist
         device_save_path = os.path.join(save_path + device)
         os.makedirs(device_save_path, exist_ok=True)
 
         files = sorted(glob.glob(os.path.join(base_path + device, 'nat', '*.*')))
+        prefetch_orientations(files)
         for img_path in files:
             print_status(img_path)
             # Build the output image path; uses last 18 characters of original file name
             save_path_image = os.path.join(device_save_path, os.path.basename(img_path)[-18:])
 
-            img = cv2.imread(img_path)
+            img = imread_aligned(img_path)
             if img is None:
                 continue
-            img = rotate_image(img, img_path)
             
             # Apply median filtering
-            img_anonymized = median_filter(img, 3)
-            
+            img_filtered = median_filter(img, 3)
+
+            # Each correction scales the residual left by the previous one, so the
+            # anonymized image is always img - strength * noise_residual, with the
+            # strength being the product of the alphas: correlate img and the residual once
+            noise_residual = img.astype(np.float32) - img_filtered
+            correlation = LinearCrossCorrelation(img, noise_residual, fingerprint)
+
             # Initialize parameters for noise correction
             alpha_0, alpha_1 = 0, 1
-            v_pce = pce_color(crosscorr_2d_color(img_anonymized, fingerprint))
+            strength = 1.0
+            v_pce = correlation.pce(strength)
             print_status(v_pce)
             iteration = 0
             
@@ -56,15 +63,18 @@ def main(devices: list[str]) -> None:
             while v_pce > 50 and iteration < 10:
                 alpha_2 = alpha_1 + (alpha_1 - alpha_0) / 10
                 alpha_0, alpha_1 = alpha_1, alpha_2
-                
-                # Vectorized noise correction over all channels
-                noise_residual = img - img_anonymized
-                img_anonymized = img - alpha_2 * noise_residual
+                strength *= alpha_2
 
-                v_pce = pce_color(crosscorr_2d_color(img_anonymized, fingerprint))
+                v_pce = correlation.pce(strength)
                 print_status(v_pce)
                 iteration += 1
 
+            if iteration == 0:
+                img_anonymized = img_filtered
+            else:
+                # Vectorized noise correction over all channels
+                img_anonymized = img - strength * noise_residual
+
             img_anonymized = rotate_back_image(img_anonymized, img_path)
             if not img_anonymized is None:
                 cv2.imwrite(save_path_image, img_anonymized)
@@ -1,5 +1,8 @@
 from utils.constants import BASEPATH, FINGERPRINTSPATH_EVALUATION, OUTPUTPATH, OUTPUT_GRAPHS_FOLDER
-from metrics.metrics_calculator import compute_pce
+from utils.identification import DeviceIdentifier
+from utils.rotate_image import rotate_image, get_orientation
+from utils.result_cache import result_cache, correlation_key, array_digest
+from utils.fingerprint_store import load_fingerprint, fingerprint_sources
 from sklearn.metrics import confusion_matrix
 import matplotlib.pyplot as plt
 import concurrent.futures
@@ -7,25 +10,69 @@ import seaborn as sns
 import numpy as np
 import json
 import glob
+import cv2
 import os
 
+# One identifier per worker process, so that the fingerprints are loaded and transformed once
+_identifier = None
+
+def evaluation_fingerprints(folder=FINGERPRINTSPATH_EVALUATION, devices=range(1, 36)):
+    """
+    :param folder: split folder of the fingerprints
+    :param devices: device numbers
+    :return: {device: memory mapped evaluation fingerprint}, for the devices whose fingerprint exists
+    """
+    fingerprints = {}
+    for d in devices:
+        try:
+            fingerprints[d] = load_fingerprint(folder, f'D{str(d).zfill(2)}')
+        except FileNotFoundError:
+            continue
+    return fingerprints
+
+def init_identifier(folder=FINGERPRINTSPATH_EVALUATION, devices=range(1, 36)):
+    """
+    Each worker maps the fingerprints from the store of their split: all the workers share the same pages
+    :param folder: split folder of the fingerprints
+    :param devices: device numbers
+    """
+    global _identifier
+    _identifier = DeviceIdentifier(evaluation_fingerprints(folder, devices))
+
 def find_best_fingerprint(original_path: str, anonymized_path: str):
     print("Finding best fingerprint for", anonymized_path)
+    if _identifier is None:
+        init_identifier()
     max_pce = 0
     best_device = 0
     result = {}
-    for d in range(1, 36):
+
+    # PCEs are cached by the content of the probe and of the fingerprints: only the missing ones are computed
+    cache = result_cache()
+    orientation = get_orientation(original_path)
+    keys = {}
+    for d, fingerprint in _identifier.fingerprints.items():
         fingerprint_file = os.path.join(FINGERPRINTSPATH_EVALUATION, f'Fingerprint_D{str(d).zfill(2)}.npy')
-        if not os.path.exists(fingerprint_file):
-            # print(f"Warning: File {fingerprint_file} not found.")
-            continue
-        fingerprint = np.load(fingerprint_file).astype(np.float32)
-        fingerprint = np.repeat(fingerprint[..., np.newaxis], 3, axis=2)
-        # print("Calculating pce with fingerprint device", d)
-        pce = compute_pce(original_path, anonymized_path, fingerprint)
-        if pce is None:
-            continue
-        result[d] = pce
+        fingerprint_id = array_digest(fingerprint, fingerprint_sources(fingerprint_file))
+        keys[d] = correlation_key(anonymized_path, orientation, fingerprint_id)
+    cached = {d: cache.get(key) for d, key in keys.items()}
+    missing = [d for d, value in cached.items() if value is None]
+
+    if missing:
+        # Decode and orient the probe once for all the devices
+        anonymized = cv2.imread(anonymized_path)
+        if anonymized is None:
+            return str(best_device).zfill(2), result
+        anonymized = rotate_image(anonymized.astype(np.float32), original_path)
+        if anonymized is None:
+            return str(best_device).zfill(2), result
+
+        for d, value in _identifier.correlate_all(anonymized, devices=missing).items():
+            cached[d] = value
+            cache.put(keys[d], value)
+
+    result = {d: value['pce'] for d, value in cached.items()}
+    for d, pce in result.items():
         if pce > max_pce:
             max_pce = pce
             best_device = d
@@ -109,7 +156,10 @@ def generate_confusion_matrix(algorithms_list, devices_list):
         # ------------------------------------------------------------------------------
         # 2) Use ProcessPoolExecutor to parallelize the computation
         # ------------------------------------------------------------------------------
-        with concurrent.futures.ProcessPoolExecutor(max_workers=6) as executor:
+        # Every worker maps the fingerprints from the fingerprint store
+        initargs = (FINGERPRINTSPATH_EVALUATION, list(range(1, 36)))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=6, initializer=init_identifier,
+                                                    initargs=initargs) as executor:
             results = list(executor.map(process_file, tasks))
 
         # Collect results from parallel execution
@@ -1,4 +1,5 @@
 from utils.constants import OUTPUTPATH, OUTPUT_GRAPHS_FOLDER
+from utils.ccn import delta_ccn
 from matplotlib.patches import Patch
 import matplotlib.pyplot as plt
 import numpy as np
@@ -11,7 +12,7 @@ def generate_histogram(algorithms_list, devices_list):
       - Top: wpsnr
       - Second: ssim
       - Third: (initial_pce - pce)
-      - Bottom: (initial_ccn - ccn)
+      - Bottom: (initial_ccn_2d - ccn_2d), or (initial_ccn - ccn) for older metrics files
     
     Parameters:
         algorithms_list (list): List of algorithm identifiers (1, 2, or 3).
@@ -28,8 +29,8 @@ def generate_histogram(algorithms_list, devices_list):
                 "ssim": ...,
                 "initial_pce": ...,
                 "pce": ...,
-                "initial_ccn": ...,
-                "ccn": ...
+                "initial_ccn_2d": ...,
+                "ccn_2d": ...
             },
             "D04_I_nat_0002.jpg": { ... },
             ...
@@ -76,7 +77,7 @@ def generate_histogram(algorithms_list, devices_list):
                         wpsnr = values.get("wpsnr")
                         ssim = values.get("ssim")
                         diff_pce = max(values.get("initial_pce") - values.get("pce"), 0) / values.get("initial_pce")
-                        diff_ccn = max(max(values.get("initial_ccn"), 0) - max(values.get("ccn"), 0), 0) / max(values.get("initial_ccn"), 0.01)
+                        diff_ccn = max(delta_ccn(values), 0)
                         data[algo_name][image_name] = (wpsnr, ssim, diff_pce, diff_ccn)
             else:
                 # For multiple devices, compute the average over all images for this device.
@@ -89,7 +90,7 @@ def generate_histogram(algorithms_list, devices_list):
                         wpsnr_vals.append(values.get("wpsnr"))
                         ssim_vals.append(values.get("ssim"))
                         diff_pce_vals.append(max(values.get("initial_pce") - values.get("pce"), 0) / values.get("initial_pce"))
-                        diff_ccn_vals.append(max(max(values.get("initial_ccn"), 0) - max(values.get("ccn"), 0), 0) / max(values.get("initial_ccn"), 0.01))
+                        diff_ccn_vals.append(max(delta_ccn(values), 0))
                 if len(wpsnr_vals) > 0:
                     avg_wpsnr = np.mean(wpsnr_vals)
                     avg_ssim = np.mean(ssim_vals)
@@ -1,10 +1,11 @@
 from skimage.metrics import structural_similarity as ssim
 from utils.constants import BASEPATH, FINGERPRINTSPATH_EVALUATION
-from utils.cross_correlation import crosscorr_2d_color
-from utils.rotate_image import rotate_image
+from utils.cross_correlation import crosscorr_2d_color, fingerprint_spectrum
+from utils.rotate_image import rotate_image, imread_aligned, get_orientation
+from utils.result_cache import result_cache, cache_key, correlation_key, file_digest, array_digest
+from utils.fingerprint_store import FingerprintRef, open_store, resolve_fingerprint, fingerprint_sources
 from joblib import Parallel, delayed
-from utils.pce import pce_color
-from utils.ccn import ccn_fft
+from utils.pce import correlation_stats
 from utils.wpsnr import wpsnr
 import multiprocessing
 import numpy as np
@@ -13,11 +14,15 @@ import json
 import cv2
 import os
 
-def compute_metrics(original_path, anonymized_path, fingerprint):
-    if not os.path.exists(anonymized_path):
-        return None
+def correlation_result(stats):
+    """
+    :param stats: as from correlation_stats
+    :return: {'pce': PCE value, 'peak': [y, x] position of the peak}, as cached with correlation_key
+    """
+    return {'pce': stats['pce'], 'peak': stats['peak']}
 
-    original = cv2.imread(original_path)
+def load_pair(original_path, anonymized_path):
+    original = imread_aligned(original_path)
     if original is None:
         return None
     
@@ -25,26 +30,90 @@ def compute_metrics(original_path, anonymized_path, fingerprint):
     if anonymized is None:
         return None
 
-    original = rotate_image(original.astype(np.float32), original_path)
+    # Anonymized images are saved without EXIF data: rotate them as their original
+    original = original.astype(np.float32)
     anonymized = rotate_image(anonymized.astype(np.float32), original_path)
     if original is None or anonymized is None:
         return None
 
-    print("Calculating", os.path.basename(original_path))
+    return original, anonymized
+
+def compute_metrics(original_path, anonymized_path, fingerprint, device=None):
+    # fingerprint may be a FingerprintRef, mapped from the fingerprint store without copies
+    fingerprint = resolve_fingerprint(fingerprint)
+
+    if not os.path.exists(anonymized_path):
+        return None
+
+    # Results are cached by the content of the images and of the fingerprint: the metrics of the
+    # original images are shared by all the algorithms, and unchanged pairs are not even decoded
+    cache = result_cache()
+    orientation = get_orientation(original_path)
+    fingerprint_id = array_digest(fingerprint, None if device is None else fingerprint_sources(device))
+    keys = {
+        'quality': cache_key('quality', file_digest(original_path), file_digest(anonymized_path), orientation),
+        'initial_pce': correlation_key(original_path, orientation, fingerprint_id),
+        'pce': correlation_key(anonymized_path, orientation, fingerprint_id),
+        'initial_ccn_2d': cache_key('ccn_2d', file_digest(original_path), orientation, fingerprint_id),
+        'ccn_2d': cache_key('ccn_2d', file_digest(anonymized_path), orientation, fingerprint_id),
+    }
+    cached = {name: cache.get(key) for name, key in keys.items()}
+
+    if any(value is None for value in cached.values()):
+        images = load_pair(original_path, anonymized_path)
+        if images is None:
+            return None
+        original, anonymized = images
+
+        print("Calculating", os.path.basename(original_path))
+
+        # Workers keep the spectrum of the device fingerprint between tasks
+        spectrum = fingerprint_spectrum(fingerprint, device=device)
+
+        # PCE, peak and CCN of an image all come from its one correlation map
+        stats = {}
+
+        def image_stats(image_name):
+            if image_name not in stats:
+                image = original if image_name == 'original' else anonymized
+                stats[image_name] = correlation_stats(crosscorr_2d_color(image, spectrum))
+            return stats[image_name]
+
+        computations = {
+            'quality': lambda: {'wpsnr': float(wpsnr(original, anonymized)),
+                                'ssim': float(ssim(original, anonymized, multichannel=True, channel_axis=2,
+                                                   data_range=anonymized.max() - anonymized.min()))},
+            'initial_pce': lambda: correlation_result(image_stats('original')),
+            'pce': lambda: correlation_result(image_stats('anonymized')),
+            'initial_ccn_2d': lambda: image_stats('original')['ccn_2d'],
+            'ccn_2d': lambda: image_stats('anonymized')['ccn_2d'],
+        }
+        for name, value in cached.items():
+            if value is None:
+                cached[name] = computations[name]()
+                cache.put(keys[name], cached[name])
 
     results = {}
-    results['wpsnr'] = float(wpsnr(original, anonymized))
-    results['ssim'] = float(ssim(original, anonymized, multichannel=True, channel_axis=2, data_range=anonymized.max() - anonymized.min()))
-    results['initial_pce'] = float(pce_color(crosscorr_2d_color(original, fingerprint)))
-    results['pce'] = float(pce_color(crosscorr_2d_color(anonymized, fingerprint)))
-    results['initial_ccn'] = float(ccn_fft(original, fingerprint))
-    results['ccn'] = float(ccn_fft(anonymized, fingerprint))
+    results['wpsnr'] = cached['quality']['wpsnr']
+    results['ssim'] = cached['quality']['ssim']
+    results['initial_pce'] = cached['initial_pce']['pce']
+    results['pce'] = cached['pce']['pce']
+    # 2D CCN, see correlation_stats: not comparable with the ccn fields (ccn_fft) of older metrics files
+    results['initial_ccn_2d'] = cached['initial_ccn_2d']
+    results['ccn_2d'] = cached['ccn_2d']
 
     return (os.path.basename(original_path), results)
 
-def compute_pce(original_path, anonymized_path, fingerprint):
+def compute_pce(original_path, anonymized_path, fingerprint, device=None):
     if not os.path.exists(anonymized_path):
         return None
+
+    fingerprint = resolve_fingerprint(fingerprint)
+    fingerprint_id = array_digest(fingerprint, None if device is None else fingerprint_sources(device))
+    key = correlation_key(anonymized_path, get_orientation(original_path), fingerprint_id)
+    cached = result_cache().get(key)
+    if cached is not None:
+        return cached['pce']
     
     anonymized = cv2.imread(anonymized_path)
     if anonymized is None:
@@ -54,7 +123,10 @@ def compute_pce(original_path, anonymized_path, fingerprint):
     if anonymized is None:
         return None
 
-    return float(pce_color(crosscorr_2d_color(anonymized, fingerprint)))
+    cc = crosscorr_2d_color(anonymized, fingerprint_spectrum(fingerprint, device=device))
+    result = correlation_result(correlation_stats(cc))
+    result_cache().put(key, result)
+    return result['pce']
 
 
 
@@ -68,12 +140,10 @@ def main(chosen_devices: list[str], anonymized_images: str):
         files = sorted(glob.glob(BASEPATH + 'D' + device + '/nat/*.*'))
         
         fp_path = os.path.join(FINGERPRINTSPATH_EVALUATION, f'Fingerprint_D{device}.npy')
-        try:
-            fingerprint = np.load(fp_path).astype(np.float32)
-        except FileNotFoundError:
+        store = open_store(FINGERPRINTSPATH_EVALUATION)
+        if not os.path.exists(fp_path) and (store is None or f'D{device}' not in store):
             print(f"Fingerprint file {fp_path} not found.")
             continue
-        fingerprint = np.repeat(fingerprint[..., np.newaxis], 3, axis=2)
 
         if not os.path.exists(anonymized_images):
             print(f"{anonymized_images} folder does not exist")
@@ -86,8 +156,10 @@ def main(chosen_devices: list[str], anonymized_images: str):
             anonymized_path = os.path.join(anonymized_images, f'D{device}', os.path.basename(original_path))
             tasks.append((original_path, anonymized_path))
 
+        # Workers map the fingerprint from the fingerprint store instead of receiving a copy per task
+        fingerprint = FingerprintRef(FINGERPRINTSPATH_EVALUATION, f'D{device}')
         results = Parallel(n_jobs=n_jobs)(
-            delayed(compute_metrics)(orig, anon, fingerprint) 
+            delayed(compute_metrics)(orig, anon, fingerprint, fp_path)
             for (orig, anon) in tasks
         )
 
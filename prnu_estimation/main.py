@@ -1,7 +1,8 @@
 from utils.parse_input import parse_device_input
-from utils.extraction import extract_multiple_aligned
-from utils.rotate_image import rotate_image
+from utils.extraction import extract_multiple_devices, PRNUAccumulator
+from utils.rotate_image import imread_aligned, prefetch_orientations
 from multiprocessing import cpu_count
+from utils.fingerprint_store import pack_fingerprints
 from utils.constants import BASEPATH
 from scipy.io import savemat
 import numpy as np
@@ -9,59 +10,114 @@ import glob
 import cv2
 
 
-def extract_fingerprint(files, device_path, folder):
-    print("Number of files for fingerprint ", folder, ":", len(files))
-    K_k = []
-    imgs = []
-    group_size = 30
-    idx_1 = 0
-    idx_2 = 0
-    for img_name in files:
-        print(f"[ESTIMATING FINGERPRINT] {img_name}")
+def load_flat_image(img_name):
+    """
+    Decode a flat image in the orientation of the sensor.
+    Images whose orientation can not be used are kept only if they are landscape
+    :param img_name: image path
+    :return: image of type np.uint8, None if discarded
+    """
+    print(f"[ESTIMATING FINGERPRINT] {img_name}")
+    img = imread_aligned(img_name)
+    if img is None:
         img = cv2.imread(img_name)
-        
-        try:
-            img = rotate_image(img, img_name)
-            # print(img)
-            imgs += [img.astype(dtype=np.uint8)]
-        except:
-            if np.shape(img)[0]<np.shape(img)[1]:
-                imgs += [img.astype(dtype=np.uint8)]
-
-    if not len(imgs):
-        for img_name in files:
-            img = cv2.imread(img_name)
-            if np.shape(img)[0]<np.shape(img)[1]:
-                imgs += [img.astype(dtype=np.uint8)]
-    
-    if not len(imgs):
-        print('No images found for device', device_path[-3:])
-        return
-    print('compute fingerprint', device_path[-3:], ' with: ', len(imgs), 'IMAGES')
-    K_k += [extract_multiple_aligned(imgs, processes=cpu_count(), sigma=3)]
-    K_k = np.stack(K_k, 0)
-
-    del imgs
-    K = np.squeeze(K_k, axis=0)
-    out_name = 'fingerprints/'+folder+'/Fingerprint_' + device_path[-3:] + '.npy'
-    np.save(out_name, K)
-
-def estimate(devices_list: list[str]):
+        if img is None or np.shape(img)[0] >= np.shape(img)[1]:
+            return None
+    return img.astype(dtype=np.uint8)
+
+
+def default_splits(files):
+    """
+    Evaluation and anonymization halves, the anonymization half being further divided in k1 and k2
+    :param files: sorted flat images of a device
+    :return: {fingerprints folder: files}
+    """
+    half = len(files)//2
+    quarter = len(files)//4
+    return {
+        'evaluation': files[:half],
+        'anonymization': files[half:],
+        'anonymization_k1': files[half:half + quarter],
+        'anonymization_k2': files[half + quarter:],
+    }
+
+
+def fingerprint_path(folder, device_path):
+    return 'fingerprints/'+folder+'/Fingerprint_' + device_path[-3:] + '.npy'
+
+
+def accumulator_path(folder, device_path):
+    """
+    Accumulated residuals and contributing files of a fingerprint, saved next to it
+    """
+    return 'fingerprints/'+folder+'/Fingerprint_' + device_path[-3:] + '.acc.npz'
+
+
+def save_accumulators(device_path, accumulators):
+    for folder, acc in accumulators.items():
+        acc.save(accumulator_path(folder, device_path))
+
+
+def save_fingerprints(fingerprints, device_path):
+    for folder, (K, n_images) in fingerprints.items():
+        if K is None:
+            print('No images found for device', device_path[-3:], 'in', folder)
+            continue
+        print('computed fingerprint', device_path[-3:], folder, ' with: ', n_images, 'IMAGES')
+
+        out_name = fingerprint_path(folder, device_path)
+        np.save(out_name, K)
+
+
+def load_accumulators(splits, device_path):
+    """
+    Resume from the saved accumulators: only the images which are not part of them yet are processed
+    """
+    accumulators = {folder: PRNUAccumulator.load(accumulator_path(folder, device_path), sigma=3) for folder in splits}
+    for folder, acc in accumulators.items():
+        if acc.count:
+            print("Resuming fingerprint", folder, device_path[-3:], "from", acc.count, "images")
+    return accumulators
+
+
+def estimate(devices_list: list[str], splits=default_splits, store_dtype=np.float32):
+    """
+    Estimate the fingerprints of the chosen devices.
+    All the devices share the same pool of processes: the images of the next device are decoded and extracted
+    while the previous device is completed, and fingerprints are finalized while the extraction goes on
+    :param devices_list: devices, as from parse_device_input
+    :param splits: function returning {fingerprints folder: files} from the sorted flat images of a device
+    :param store_dtype: type of the packed fingerprints, see pack_fingerprints
+    """
 
     devices = sorted(glob.glob(BASEPATH+'D*'))
 
+    device_splits = {}
     for device_path in devices:
         if device_path[-2:] not in devices_list:
             continue
         files = sorted(glob.glob(device_path + '/flat/*.*'))
+        prefetch_orientations(files)
         print("Number of files found for device", device_path[-3:], ":", len(files))
-        extract_fingerprint(files[:len(files)//2], device_path, 'evaluation')
-        extract_fingerprint(files[len(files)//2:], device_path, 'anonymization')
-        # i have to devide files[len(files)//2:] in two parts, one for k1 and one for k2
-        k1 = files[len(files)//2:len(files)//2 + len(files)//4]
-        k2 = files[len(files)//2 + len(files)//4:]
-        extract_fingerprint(k1, device_path, 'anonymization_k1')
-        extract_fingerprint(k2, device_path, 'anonymization_k2')
+        device_splits[device_path] = splits(files)
+        for folder, folder_files in device_splits[device_path].items():
+            print("Number of files for fingerprint ", folder, ":", len(folder_files))
+
+    # Saved accumulators are loaded by device, their sums only when the device is processed or finalized
+    def accumulators(device_path):
+        return load_accumulators(device_splits[device_path], device_path)
+
+    for device_path, fingerprints in extract_multiple_devices(device_splits, loader=load_flat_image,
+                                                              processes=cpu_count(), sigma=3,
+                                                              accumulators=accumulators,
+                                                              checkpoint=save_accumulators):
+        save_fingerprints(fingerprints, device_path)
+
+    # Pack the fingerprints of each split in a single memory mappable store
+    folders = {folder for splits_files in device_splits.values() for folder in splits_files}
+    for folder in sorted(folders):
+        store = pack_fingerprints('fingerprints/' + folder, store_dtype)
+        print("Packed", len(store.devices()), "fingerprints in", store.folder)
 
 
 def menu():
@@ -1,5 +1,10 @@
+from utils.fft_backend import rfft, irfft
 import numpy as np
 
+# Floors of the initial CCN in relative decreases, on the scale of each definition
+CCN_FLOOR = 0.01
+CCN_2D_FLOOR = 1.0
+
 # Cross-correlation norm
 def ccn_fft(x, y, neighbors=30):
     """
@@ -8,19 +13,21 @@ def ccn_fft(x, y, neighbors=30):
     c(x, y) = r_xy(0) / sqrt( (Σ_{m not in [0..neighbors]} [r_xy(m)]^2 ) / (N - neighbors) )
 
     where r_xy(m) = (1/N) * Σ_{i=0}^{N-1} x[i] * y[(i+m) mod N].
+
+    A grayscale (H, W) y paired with a color (H, W, C) x is repeated over the channels.
     """
+    if y.ndim == x.ndim - 1:
+        y = np.broadcast_to(y[..., np.newaxis], x.shape)
     x = np.ravel(x).astype(np.float32)
     y = np.ravel(y).astype(np.float32)
     N = len(x)
     
-    X = np.fft.fft(x)
-    Y = np.fft.fft(y)
+    # Both inputs are real: half spectra are enough
+    X = rfft(x)
+    Y = rfft(y)
     
     # R[m] = Σ x[i] * y[(i+m) mod N]
-    R = np.fft.ifft(X * np.conjugate(Y))
-    
-    # May have very small imaginary parts, so we take the real part
-    R = R.real
+    R = irfft(X * np.conjugate(Y), n=N)
     
     # r_xy(m) = R[m] / N
     # Numerator: r_xy(0) = R[0] / N
@@ -32,4 +39,19 @@ def ccn_fft(x, y, neighbors=30):
     
     den = np.sqrt(sum_r_xy_sq / (N - neighbors))
     
-    return num / den
\ No newline at end of file
+    return num / den
+
+
+def delta_ccn(metrics: dict) -> float:
+    """
+    Relative decrease of the CCN of an anonymized image, from its entry of a metrics.json file.
+    Uses the 2D CCN (initial_ccn_2d, ccn_2d, see correlation_stats) when present, otherwise the CCN of ccn_fft
+    (initial_ccn, ccn) of the metrics files computed before it. Negative CCNs count as 0
+    :param metrics: metrics of the image
+    :return: (initial CCN - CCN) / initial CCN, the initial CCN being at least the floor of its definition
+    """
+    if 'ccn_2d' in metrics:
+        initial, final, floor = metrics['initial_ccn_2d'], metrics['ccn_2d'], CCN_2D_FLOOR
+    else:
+        initial, final, floor = metrics['initial_ccn'], metrics['ccn'], CCN_FLOOR
+    return (max(initial, 0) - max(final, 0)) / max(initial, floor)
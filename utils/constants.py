@@ -4,4 +4,6 @@ FINGERPRINTSPATH_ANONYMIZATION = 'fingerprints/anonymization/'
 FINGERPRINTSPATH_ANONYMIZATION_K1 = 'fingerprints/anonymization_k1/'
 FINGERPRINTSPATH_ANONYMIZATION_K2 = 'fingerprints/anonymization_k2/'
 FINGERPRINTSPATH_EVALUATION = 'fingerprints/evaluation'
-OUTPUT_GRAPHS_FOLDER = 'graphs/outputs/'
\ No newline at end of file
+OUTPUT_GRAPHS_FOLDER = 'graphs/outputs/'
+RESULT_CACHE_PATH = 'cache/'
+RESULT_CACHE_SIZE = 2 * 1024 ** 3
\ No newline at end of file
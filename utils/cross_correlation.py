@@ -1,66 +1,424 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from utils.fft_backend import rfft2, irfft2
+from utils.pce import pce_color, pce_batch, ENERGY_BLOCK_SIZE
 import numpy as np
-from numpy.fft import fft2, ifft2
+import os
 
 """
 Cross-correlation functions
 """
 
-def crosscorr_2d_color(k1: np.ndarray, k2: np.ndarray) -> np.ndarray:
+def _padded_zero_mean(k: np.ndarray, shape: tuple) -> np.ndarray:
+    """
+    Cast a 2D matrix to float32, subtract its mean and zero pad it to shape
+    :param k: 2D matrix
+    :param shape: (height, width) after padding
+    :return: 2D matrix of size shape
+    """
+    k = k.astype(np.float32)
+    k -= k.mean()
+    return np.pad(k, ((0, shape[0] - k.shape[0]), (0, shape[1] - k.shape[1])),
+                  mode='constant', constant_values=0)
+
+
+class FingerprintSpectrum:
+    """
+    Precomputed FFT of a fingerprint, as used by crosscorr_2d_color.
+    Computing it once per device avoids transforming the fingerprint again for
+    every probe image: after the first use only the probe FFT is computed.
+    Grayscale (2D) fingerprints keep a single real-input spectrum (rfft2) shared by all the probe channels.
+    """
+
+    def __init__(self, fingerprint: np.ndarray, device: str = None, shape: tuple = None, orientation: int = 0,
+                 dtype: type = np.complex64):
+        """
+        :param fingerprint: 2D matrix (H, W) or 3D matrix (H, W, C)
+        :param device: identifier of the fingerprint (e.g. its file path), used as cache key
+        :param shape: (height, width) of the correlation map, defaults to the fingerprint size
+        :param orientation: number of 90 degrees counter-clockwise rotations applied to the fingerprint
+        :param dtype: complex type of the stored spectrum, np.complex128 doubles its memory
+        """
+        assert fingerprint.ndim in [2, 3], "Fingerprint must be 2D: (H, W) or 3D: (H, W, C)."
+
+        fingerprint = np.rot90(fingerprint, orientation)
+        if shape is None:
+            shape = fingerprint.shape[:2]
+        shape = tuple(shape)
+        if shape[0] < fingerprint.shape[0] or shape[1] < fingerprint.shape[1]:
+            raise ValueError('Spectrum shape {} smaller than fingerprint shape {}'.format(shape, fingerprint.shape))
+
+        self.device = device
+        self.shape = shape
+        self.orientation = orientation
+        self.gray = fingerprint.ndim == 2
+        self.channels = None if self.gray else fingerprint.shape[2]
+        self.fingerprint = fingerprint
+        self._padded = None
+
+        # Real-input FFT of the fingerprint rotated by 180 degrees
+        # (equivalent to cross-correlation via convolution)
+        if self.gray:
+            self.spectrum = rfft2(np.rot90(_padded_zero_mean(fingerprint, shape), 2)).astype(dtype, copy=False)
+        else:
+            self.spectrum = np.empty((self.channels, shape[0], shape[1] // 2 + 1), dtype)
+            for c in range(self.channels):
+                self.spectrum[c] = rfft2(np.rot90(_padded_zero_mean(fingerprint[..., c], shape), 2))
+
+    def padded(self) -> np.ndarray:
+        """
+        Zero mean fingerprint, zero padded to the spectrum shape. Computed on first use, for the aligned mode
+        :return: 2D matrix, or (C, H, W) matrix for color fingerprints
+        """
+        if self._padded is None:
+            if self.gray:
+                self._padded = _padded_zero_mean(self.fingerprint, self.shape)
+            else:
+                self._padded = np.stack([_padded_zero_mean(self.fingerprint[..., c], self.shape)
+                                         for c in range(self.channels)])
+        return self._padded
+
+
+# Spectra are large (H * W * C complex values), keep only the most recent ones
+SPECTRUM_CACHE_SIZE = 2
+_spectrum_cache = OrderedDict()
+
+
+def _file_version(device) -> tuple:
+    """
+    :param device: identifier of a fingerprint
+    :return: (mtime, size) of the file if device is an existing file path, so a regenerated fingerprint
+             is not served from the cache, None otherwise
+    """
+    if isinstance(device, str):
+        try:
+            stat = os.stat(device)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+    return None
+
+
+def fingerprint_spectrum(fingerprint: np.ndarray, device: str = None, shape: tuple = None,
+                         orientation: int = 0) -> FingerprintSpectrum:
+    """
+    Get the spectrum of a fingerprint, reusing a cached one for the same (device, shape, orientation).
+    When device is the path of the fingerprint file, its modification time is part of the key
+    :param fingerprint: 2D matrix (H, W) or 3D matrix (H, W, C)
+    :param device: identifier of the fingerprint (e.g. its file path). If None the spectrum is not cached
+    :param shape: (height, width) of the correlation map, defaults to the fingerprint size
+    :param orientation: number of 90 degrees counter-clockwise rotations applied to the fingerprint
+    :return: FingerprintSpectrum
+    """
+    if shape is None:
+        shape = np.rot90(fingerprint, orientation).shape[:2]
+    key = (device, _file_version(device), tuple(shape), orientation)
+
+    if device is not None and key in _spectrum_cache:
+        _spectrum_cache.move_to_end(key)
+        return _spectrum_cache[key]
+
+    spectrum = FingerprintSpectrum(fingerprint, device=device, shape=shape, orientation=orientation)
+
+    if device is not None:
+        _spectrum_cache[key] = spectrum
+        while len(_spectrum_cache) > SPECTRUM_CACHE_SIZE:
+            _spectrum_cache.popitem(last=False)
+
+    return spectrum
+
+
+def probe_spectrum(k1: np.ndarray, shape: tuple) -> np.ndarray:
+    """
+    Spectrum of a color probe, to be correlated with grayscale fingerprint spectra of the given shape.
+    Computing it once allows correlating the same probe with many fingerprints (see crosscorr_spectra)
+    :param k1: 3D matrix (H, W, C)
+    :param shape: (height, width) of the correlation map
+    :return: rfft2 of the sum of the zero mean channels of k1, zero padded to shape
+    """
+    return rfft2(_probe_sum(k1, shape))
+
+
+def _probe_sum(k1: np.ndarray, shape: tuple) -> np.ndarray:
+    """
+    :param k1: 3D matrix (H, W, C)
+    :param shape: (height, width) after padding
+    :return: sum of the zero mean channels of k1, zero padded to shape
+    """
+    # Sum of the zero mean channels of k1
+    k1_sum = np.zeros(k1.shape[:2], dtype=np.float32)
+    for c in range(k1.shape[2]):
+        k1_c = k1[..., c].astype(np.float32)
+        k1_sum += k1_c
+        k1_sum -= k1_c.mean()
+
+    return np.pad(k1_sum, ((0, shape[0] - k1_sum.shape[0]), (0, shape[1] - k1_sum.shape[1])),
+                  mode='constant', constant_values=0)
+
+
+def crosscorr_spectra(k1_fft: np.ndarray, k2: FingerprintSpectrum) -> np.ndarray:
+    """
+    Cross-correlation between a probe spectrum and a grayscale fingerprint spectrum
+    :param k1_fft: as from probe_spectrum, with the same shape as k2
+    :param k2: FingerprintSpectrum of a 2D fingerprint
+    :return: 2D cross-correlation matrix
+    """
+    assert k2.gray, "k2 must be the spectrum of a 2D fingerprint."
+    return irfft2(k1_fft * k2.spectrum, s=k2.shape).astype(np.float32)
+
+
+def crosscorr_2d_color(k1: np.ndarray, k2) -> np.ndarray:
     """
     Compute the cross-correlation between two color (3D) images/fingerprints.
     Each has shape (height, width, channels). The result is a 2D cross-correlation
     matrix of shape (max_height, max_width).
 
+    A grayscale (2D) k2 stands for a fingerprint repeated over all the channels of k1.
+    Since the correlation is linear, the sum of the channel correlations is then the
+    correlation of the sum of the zero mean channels of k1: a single FFT pair is computed.
+
     :param k1: 3D matrix (H, W, C)
-    :param k2: 3D matrix (H, W, C)
+    :param k2: 3D matrix (H, W, C), 2D matrix (H, W), or their FingerprintSpectrum
     :return: 2D cross-correlation matrix
     """
     # Check input dimensions
-    assert k1.ndim == 3 and k2.ndim == 3, "Both inputs must be 3D: (H, W, C)."
-    assert k1.shape[2] == k2.shape[2], "Number of channels must match."
-    
+    assert k1.ndim == 3, "k1 must be 3D: (H, W, C)."
+
+    if isinstance(k2, FingerprintSpectrum):
+        # The probe does not fit the precomputed spectrum: get one of the right size
+        if k1.shape[0] > k2.shape[0] or k1.shape[1] > k2.shape[1]:
+            k2 = fingerprint_spectrum(k2.fingerprint, device=k2.device,
+                                      shape=(max(k1.shape[0], k2.shape[0]), max(k1.shape[1], k2.shape[1])))
+    else:
+        assert k2.ndim in [2, 3], "k2 must be 2D: (H, W) or 3D: (H, W, C)."
+        k2 = FingerprintSpectrum(k2, shape=(max(k1.shape[0], k2.shape[0]), max(k1.shape[1], k2.shape[1])))
+
+    assert k2.gray or k1.shape[2] == k2.channels, "Number of channels must match."
+
+    if k2.gray:
+        return crosscorr_spectra(probe_spectrum(k1, k2.shape), k2)
+
     # Determine the final correlation map size
-    max_height = max(k1.shape[0], k2.shape[0])
-    max_width  = max(k1.shape[1], k2.shape[1])
-    channels   = k1.shape[2]
-    
+    max_height, max_width = k2.shape
+    channels = k1.shape[2]
+
     # We'll accumulate the cross-correlation from each channel
     cc_sum = np.zeros((max_height, max_width), dtype=np.float32)
 
     for c in range(channels):
-        # Extract single channel
-        k1_c = k1[..., c].astype(np.float32)
-        k2_c = k2[..., c].astype(np.float32)
-
-        # Subtract mean per channel
-        k1_c -= k1_c.mean()
-        k2_c -= k2_c.mean()
-
-        # Pad to the same size
-        k1_c_padded = np.pad(k1_c,
-                             ((0, max_height - k1_c.shape[0]),
-                              (0, max_width  - k1_c.shape[1])),
-                             mode='constant', constant_values=0)
-
-        k2_c_padded = np.pad(k2_c,
-                             ((0, max_height - k2_c.shape[0]),
-                              (0, max_width  - k2_c.shape[1])),
-                             mode='constant', constant_values=0)
+        # Zero mean channel, padded to the same size
+        k1_c_padded = _padded_zero_mean(k1[..., c], (max_height, max_width))
 
         # FFT of channel 1
-        k1_c_fft = fft2(k1_c_padded)
-        # FFT of channel 2 rotated by 180 degrees 
-        # (equivalent to cross-correlation via convolution)
-        k2_c_fft = fft2(np.rot90(k2_c_padded, 2))
+        k1_c_fft = rfft2(k1_c_padded)
 
-        # Inverse FFT of product
-        cc_channel = np.real(ifft2(k1_c_fft * k2_c_fft))
+        # Inverse FFT of product, real since both inputs are
+        cc_channel = irfft2(k1_c_fft * k2.spectrum[c], s=k2.shape)
 
         # Accumulate
         cc_sum += cc_channel.astype(np.float32)
 
     return cc_sum
 
+
+def _as_spectrum(k1: np.ndarray, k2) -> FingerprintSpectrum:
+    """
+    :param k1: 3D matrix (H, W, C)
+    :param k2: 3D matrix (H, W, C), 2D matrix (H, W), or their FingerprintSpectrum
+    :return: FingerprintSpectrum of k2, large enough for k1
+    """
+    shape = (max(k1.shape[0], k2.shape[0]), max(k1.shape[1], k2.shape[1]))
+    if not isinstance(k2, FingerprintSpectrum):
+        return FingerprintSpectrum(k2, shape=shape)
+    if shape != k2.shape:
+        return fingerprint_spectrum(k2.fingerprint, device=k2.device, shape=shape)
+    return k2
+
+
+def _dot(a: np.ndarray, b: np.ndarray) -> float:
+    """
+    Dot product of two 2D matrices of the same size, accumulated in double precision by blocks of rows
+    """
+    rows = max(1, ENERGY_BLOCK_SIZE // max(1, a.shape[1]))
+    total = 0.0
+    for y0 in range(0, a.shape[0], rows):
+        total += float(np.dot(a[y0:y0 + rows].ravel(), b[y0:y0 + rows].ravel()))
+    return total
+
+
+def _shifted_dot(a: np.ndarray, k: np.ndarray, dy: int, dx: int) -> float:
+    """
+    Circular correlation of a and k at lag (dy, dx): sum of a[y, x] * k[(y + dy) % h, (x + dx) % w]
+    """
+    h, w = a.shape
+    total = 0.0
+    for a_y, k_y in ((slice(0, h - dy), slice(dy, h)), (slice(h - dy, h), slice(0, dy))):
+        for a_x, k_x in ((slice(0, w - dx), slice(dx, w)), (slice(w - dx, w), slice(0, dx))):
+            if a[a_y, a_x].size:
+                total += _dot(a[a_y, a_x], k[k_y, k_x])
+    return total
+
+
+def _rfft_weights(width: int) -> np.ndarray:
+    """
+    Multiplicity of the columns of a rfft2 spectrum in the full spectrum, for Parseval's theorem
+    :param width: width of the real input
+    :return: 1D array of width // 2 + 1 weights
+    """
+    weights = np.full(width // 2 + 1, 2.0)
+    weights[0] = 1
+    if width % 2 == 0:
+        weights[-1] = 1
+    return weights
+
+
+def _spectral_inner(p1: np.ndarray, p2: np.ndarray, shape: tuple) -> float:
+    """
+    Inner product of the two real maps irfft2(p1, s=shape) and irfft2(p2, s=shape), from their spectra
+    """
+    cross = p1.real * p2.real + p1.imag * p2.imag
+    return float(np.sum(cross, axis=0, dtype=np.float64) @ _rfft_weights(shape[1])) / (shape[0] * shape[1])
+
+
+def _aligned_terms(k1: np.ndarray, k2: FingerprintSpectrum, neigh_radius: int) -> tuple:
+    """
+    Spectrum of the cross-correlation map of k1 and k2, and its values in the neighborhood of the zero lag.
+    The zero lag sits at the last row and column of the map; the neighborhood is clipped as in pce_color
+    :param k1: 3D matrix (H, W, C)
+    :param k2: FingerprintSpectrum as large as k1
+    :param neigh_radius: radius of the neighborhood
+    :return: (rfft2 of the map, matrix of the map values at [-1 - dy, -1 - dx])
+    """
+    h, w = k2.shape
+    window = np.zeros((min(neigh_radius, h - 1) + 1, min(neigh_radius, w - 1) + 1))
+
+    if k2.gray:
+        probes = [_probe_sum(k1, k2.shape)]
+        fingerprints = [k2.padded()]
+        spectrum = rfft2(probes[0]) * k2.spectrum
+    else:
+        assert k1.shape[2] == k2.channels, "Number of channels must match."
+        probes = [_padded_zero_mean(k1[..., c], k2.shape) for c in range(k2.channels)]
+        fingerprints = list(k2.padded())
+        spectrum = sum(rfft2(probe) * k2.spectrum[c] for c, probe in enumerate(probes))
+
+    for probe, fingerprint in zip(probes, fingerprints):
+        for dy in range(window.shape[0]):
+            for dx in range(window.shape[1]):
+                window[dy, dx] += _shifted_dot(probe, fingerprint, dy, dx)
+
+    return spectrum, window
+
+
+def _aligned_pce(peak: float, window_energy: float, energy: float, size: int) -> float:
+    return peak ** 2 / ((energy - window_energy) / size) * np.sign(peak)
+
+
+def aligned_pce(k1: np.ndarray, k2, neigh_radius: int = 2, peak_search: bool = False) -> float:
+    """
+    PCE of the correlation of a probe and a fingerprint which are geometrically aligned, taking as peak the zero lag.
+    The zero lag and its neighborhood are computed by direct (circularly shifted) dot products, and the total
+    energy of the correlation map from its spectrum through Parseval's theorem: no inverse FFT is computed.
+    Same as pce_color(crosscorr_2d_color(k1, k2)) when the global maximum of the map is at the zero lag
+    :param k1: 3D matrix (H, W, C)
+    :param k2: 3D matrix (H, W, C), 2D matrix (H, W), or their FingerprintSpectrum
+    :param neigh_radius: radius around the peak to be ignored while computing floor energy
+    :param peak_search: compute the full map and look for the global maximum instead, as pce_color
+    :return: PCE value
+    """
+    if peak_search:
+        return pce_color(crosscorr_2d_color(k1, k2), neigh_radius)
+
+    k2 = _as_spectrum(k1, k2)
+    spectrum, window = _aligned_terms(k1, k2, neigh_radius)
+    energy = _spectral_inner(spectrum, spectrum, k2.shape)
+    return _aligned_pce(window[0, 0], float(np.sum(window ** 2)), energy, k2.shape[0] * k2.shape[1])
+
+
+class LinearCrossCorrelation:
+    """
+    Cross-correlation against a fingerprint of every image of the form base - strength * delta.
+    The correlation is linear (mean subtraction and zero padding included), so
+    crosscorr_2d_color(base - a * delta, k2) = crosscorr_2d_color(base, k2) - a * crosscorr_2d_color(delta, k2):
+    the two maps are computed once, then any strength is evaluated without FFTs.
+    In aligned mode (see aligned_pce) not even the maps are kept: the zero lag neighborhoods are linear in the
+    strength and the map energy quadratic, so each strength costs a few scalar operations.
+    """
+
+    def __init__(self, base: np.ndarray, delta: np.ndarray, k2, aligned: bool = False, neigh_radius: int = 2):
+        """
+        :param base: 3D matrix (H, W, C)
+        :param delta: 3D matrix (H, W, C), direction along which the strength moves the image
+        :param k2: 3D matrix (H, W, C), 2D matrix (H, W), or their FingerprintSpectrum
+        :param aligned: take the zero lag as peak, as aligned_pce
+        :param neigh_radius: radius around the peak ignored by the aligned PCE
+        """
+        assert base.shape == delta.shape, "base and delta must have the same shape."
+
+        k2 = _as_spectrum(base, k2)
+        self.aligned = aligned
+        self.neigh_radius = neigh_radius
+
+        if aligned:
+            self.size = k2.shape[0] * k2.shape[1]
+            spectrum_base, self.window_base = _aligned_terms(base, k2, neigh_radius)
+            spectrum_delta, self.window_delta = _aligned_terms(delta, k2, neigh_radius)
+            # Energy of the map of base - a * delta: energy_base - 2 * a * energy_cross + a ** 2 * energy_delta
+            self.energy_base = _spectral_inner(spectrum_base, spectrum_base, k2.shape)
+            self.energy_cross = _spectral_inner(spectrum_base, spectrum_delta, k2.shape)
+            self.energy_delta = _spectral_inner(spectrum_delta, spectrum_delta, k2.shape)
+        else:
+            self.cc_base = crosscorr_2d_color(base, k2)
+            self.cc_delta = crosscorr_2d_color(delta, k2)
+
+    def crosscorr(self, strength: float) -> np.ndarray:
+        """
+        :param strength: multiplier of delta
+        :return: 2D cross-correlation matrix of base - strength * delta
+        """
+        if self.aligned:
+            raise ValueError('Correlation maps are not computed in aligned mode')
+        return self.cc_base - np.float32(strength) * self.cc_delta
+
+    def pce(self, strength: float, neigh_radius: int = 2) -> float:
+        """
+        :param strength: multiplier of delta
+        :param neigh_radius: radius around the peak to be ignored while computing floor energy
+        :return: PCE of base - strength * delta
+        """
+        if self.aligned:
+            if neigh_radius != self.neigh_radius:
+                raise ValueError('Aligned correlation computed for neigh_radius={}'.format(self.neigh_radius))
+            window = self.window_base - strength * self.window_delta
+            energy = self.energy_base - 2 * strength * self.energy_cross + strength ** 2 * self.energy_delta
+            return _aligned_pce(window[0, 0], float(np.sum(window ** 2)), energy, self.size)
+        return pce_color(self.crosscorr(strength), neigh_radius)
+
+    def pce_batch(self, strengths, neigh_radius: int = 2, batch_size: int = 4, threads: int = None) -> np.ndarray:
+        """
+        PCE of many strengths at once. The maps of batch_size strengths are stacked and scored by pce_batch,
+        batches run in a thread pool (numpy releases the GIL on the map arithmetic)
+        :param strengths: sequence of multipliers of delta
+        :param neigh_radius: radius around the peak to be ignored while computing floor energy
+        :param batch_size: number of maps held in memory per batch
+        :param threads: number of threads, defaults to the ThreadPoolExecutor default
+        :return: array of PCE values, as pce for each strength
+        """
+        strengths = np.asarray(strengths, dtype=np.float32)
+        if self.aligned:
+            return np.array([self.pce(strength, neigh_radius) for strength in strengths])
+
+        def score(batch):
+            cc = self.cc_base[np.newaxis] - batch[:, np.newaxis, np.newaxis] * self.cc_delta[np.newaxis]
+            return pce_batch(cc, neigh_radius)[0]
+
+        batches = [strengths[idx0:idx0 + batch_size] for idx0 in range(0, len(strengths), batch_size)]
+        if len(batches) <= 1:
+            return np.concatenate([score(batch) for batch in batches]) if batches else np.zeros(0)
+        with ThreadPoolExecutor(threads) as executor:
+            return np.concatenate(list(executor.map(score, batches)))
+
+
 def crosscorr_2d(k1: np.ndarray, k2: np.ndarray):
     """
     PRNU 2D cross-correlation
@@ -81,10 +439,10 @@ def crosscorr_2d(k1: np.ndarray, k2: np.ndarray):
     k1 = np.pad(k1, [(0, max_height - k1.shape[0]), (0, max_width - k1.shape[1])], mode='constant', constant_values=0)
     k2 = np.pad(k2, [(0, max_height - k2.shape[0]), (0, max_width - k2.shape[1])], mode='constant', constant_values=0)
 
-    k1_fft = fft2(k1, )
-    k2_fft = fft2(np.rot90(k2, 2), )
+    k1_fft = rfft2(k1)
+    k2_fft = rfft2(np.rot90(k2, 2))
 
-    return np.real(ifft2(k1_fft * k2_fft)).astype(np.float32)
+    return irfft2(k1_fft * k2_fft, s=(max_height, max_width)).astype(np.float32)
 
 
 def aligned_cc(k1: np.ndarray, k2: np.ndarray) -> dict:
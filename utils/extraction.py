@@ -1,10 +1,13 @@
 from multiprocessing import Pool, cpu_count
 from sklearn.metrics import roc_curve, auc
-from numpy.fft import fft2, ifft2
-from scipy.ndimage import filters
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from collections import deque
+from itertools import chain
+from utils.fft_backend import fft2, ifft2
 from tqdm import tqdm
 import numpy as np
 import pywt
+import os
 
 class ArgumentError(Exception):
     pass
@@ -55,44 +58,25 @@ def noise_extract(im: np.ndarray, levels: int = 4, sigma: float = 5) -> np.ndarr
     if im.ndim == 2:
         im.shape += (1,)
 
-    W = np.zeros(im.shape, np.float32)
+    # Levels beyond the maximum one would only filter boundary effects
+    levels = min(levels, pywt.dwt_max_level(min(im.shape[:2]), 'db4'))
+    if levels < 1:
+        raise ValueError('Impossible to compute Wavelet filtering for input size: {}'.format(im.shape))
 
-    for ch in range(im.shape[2]):
-
-        wlet = None
-        while wlet is None and levels > 0:
-            try:
-                wlet = pywt.wavedec2(im[:, :, ch], 'db4', level=levels)
-            except ValueError:
-                levels -= 1
-                wlet = None
-        if wlet is None:
-            raise ValueError('Impossible to compute Wavelet filtering for input size: {}'.format(im.shape))
-
-        wlet_details = wlet[1:]
-
-        wlet_details_filter = [None] * len(wlet_details)
-        # Cycle over Wavelet levels 1:levels-1
-        for wlet_level_idx, wlet_level in enumerate(wlet_details):
-            # Cycle over H,V,D components
-            level_coeff_filt = [None] * 3
-            for wlet_coeff_idx, wlet_coeff in enumerate(wlet_level):
-                level_coeff_filt[wlet_coeff_idx] = wiener_adaptive(wlet_coeff, noise_var)
-            wlet_details_filter[wlet_level_idx] = tuple(level_coeff_filt)
-
-        # Set filtered detail coefficients for Levels > 0 ---
-        wlet[1:] = wlet_details_filter
-
-        # Set to 0 all Level 0 approximation coefficients ---
-        wlet[0][...] = 0
-
-        # Invert wavelet transform ---
-        wrec = pywt.waverec2(wlet, 'db4')
-        try:
-            W[:, :, ch] = wrec
-        except ValueError:
-            W = np.zeros(wrec.shape[:2] + (im.shape[2],), np.float32)
-            W[:, :, ch] = wrec
+    # All the channels are decomposed at once
+    wlet = pywt.wavedec2(im, 'db4', level=levels, axes=(0, 1))
+
+    # Cycle over Wavelet levels 1:levels-1, filtering the H,V,D components of all the channels as a single stack
+    for wlet_level_idx in range(1, len(wlet)):
+        level_coeff = np.stack(wlet[wlet_level_idx], axis=-1)
+        level_coeff_filt = wiener_adaptive(level_coeff, noise_var)
+        wlet[wlet_level_idx] = tuple(level_coeff_filt[..., coeff_idx] for coeff_idx in range(3))
+
+    # Set to 0 all Level 0 approximation coefficients ---
+    wlet[0][...] = 0
+
+    # Invert wavelet transform ---
+    W = pywt.waverec2(wlet, 'db4', axes=(0, 1)).astype(np.float32)
 
     if W.shape[2] == 1:
         W.shape = W.shape[:2]
@@ -102,72 +86,540 @@ def noise_extract(im: np.ndarray, levels: int = 4, sigma: float = 5) -> np.ndarr
     return W
 
 
+def noise_extract_tiled(im: np.ndarray, levels: int = 4, sigma: float = 5, tile_size: int = 1024,
+                        threads: int = None) -> np.ndarray:
+    """
+    Same as noise_extract, computed on overlapping tiles by a thread pool, so that the temporaries only depend on the
+    tile size. Tiles start on multiples of 2^levels, so their wavelet coefficients are the ones of the whole image,
+    and they are extended by a margin covering the db4 filters and the Wiener windows of all levels: the stitched
+    residual is the same as the one of the whole image
+    :param im: grayscale or color image, np.uint8
+    :param levels: number of wavelet decomposition levels
+    :param sigma: estimated noise power
+    :param tile_size: size of the tiles, without margins. Rounded up to a multiple of 2^levels
+    :param threads: number of threads, defaults to the number of CPUs
+    :return: noise residual
+    """
+    assert (im.dtype == np.uint8)
+    assert (im.ndim in [2, 3])
+
+    h, w = im.shape[:2]
+    levels = min(levels, pywt.dwt_max_level(min(h, w), 'db4'))
+    if levels < 1:
+        raise ValueError('Impossible to compute Wavelet filtering for input size: {}'.format(im.shape))
+
+    step = 2 ** levels
+    # Through all the levels, db4 filters and Wiener windows reach about 10 * 2^levels pixels
+    margin = 12 * step
+    tile_size = -(-tile_size // step) * step
+
+    if h <= tile_size + margin and w <= tile_size + margin:
+        return noise_extract(im, levels, sigma)
+
+    W = np.zeros(im.shape, np.float32)
+
+    def extract_tile(origin):
+        y0, x0 = origin
+        y1, x1 = min(y0 + tile_size, h), min(x0 + tile_size, w)
+        ey0, ex0 = max(y0 - margin, 0), max(x0 - margin, 0)
+        ey1, ex1 = min(y1 + margin, h), min(x1 + margin, w)
+        tile = noise_extract(im[ey0:ey1, ex0:ex1], levels, sigma)
+        W[y0:y1, x0:x1] = tile[y0 - ey0:y1 - ey0, x0 - ex0:x1 - ex0]
+
+    origins = [(y0, x0) for y0 in range(0, h, tile_size) for x0 in range(0, w, tile_size)]
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(extract_tile, origins))
+
+    return W
+
+
 def noise_extract_compact(args):
     """
     Extract residual, multiplied by the image. Useful to save memory in multiprocessing operations
-    :param args: (im, levels, sigma), see noise_extract for usage
+    :param args: (im, levels, sigma) or (im, levels, sigma, tile_size), see noise_extract and noise_extract_tiled
+                 for usage. Images are extracted by tiles if tile_size is not None
     :return: residual, multiplied by the image
     """
-    w = noise_extract(*args)
+    if len(args) > 3 and args[3] is not None:
+        w = noise_extract_tiled(*args[:4], threads=1)
+    else:
+        w = noise_extract(*args[:3])
     im = args[0]
     return (w * im / 255.).astype(np.float32)
 
 
-def extract_multiple_aligned(imgs: list, levels: int = 4, sigma: float = 5, processes: int = None,
+def noise_inten_sat_compact(args):
+    """
+    Residual and intensity/saturation contributions of an image in a single task. Useful for multiprocessing,
+    since the image is sent to the worker only once
+    :param args: (im, levels, sigma) or (im, levels, sigma, tile_size), see noise_extract_compact for usage
+    :return: (noise_extract_compact(args), inten_sat_compact(args))
+    """
+    return noise_extract_compact(args), inten_sat_compact(args)
+
+
+def extract_multiple_aligned(imgs, levels: int = 4, sigma: float = 5, processes: int = None,
                              batch_size=cpu_count(), tqdm_str: str = '') -> np.ndarray:
     """
     Extract PRNU from a list of images. Images are supposed to be the same size and properly oriented
     :param tqdm_str: tqdm description (see tqdm documentation)
-    :param batch_size: number of parallel processed images
+    :param batch_size: number of images in flight in the pool
     :param processes: number of parallel processes
-    :param imgs: list of images of size (H,W,Ch) and type np.uint8
+    :param imgs: list of images of size (H,W,Ch) and type np.uint8, or an iterable loading them one at a time
+                 (e.g. a generator), so that only batch_size images are kept in memory
     :param levels: number of wavelet decomposition levels
     :param sigma: estimated noise power
     :return: PRNU
     """
-    assert (isinstance(imgs[0], np.ndarray))
-    assert (imgs[0].ndim == 3)
-    assert (imgs[0].dtype == np.uint8)
+    RPsum = None
+    NN = None
+    for wi, ni in stream_contributions(imgs, None, levels, sigma, processes, batch_size, tqdm_str):
+        if RPsum is None:
+            assert (wi.ndim == 3)
+            RPsum = np.zeros(wi.shape, np.float32)
+            NN = np.zeros(wi.shape, np.float32)
+        RPsum += wi
+        NN += ni
+
+    return finalize_fingerprint(RPsum, NN)
+
+
+def finalize_fingerprint(RPsum: np.ndarray, NN: np.ndarray) -> np.ndarray:
+    """
+    Compute the PRNU from the accumulated residuals and intensity/saturation weights
+    :param RPsum: sum of the residuals multiplied by their images, (H,W,Ch)
+    :param NN: sum of the squared intensity/saturation weights, (H,W,Ch)
+    :return: PRNU
+    """
+    K = RPsum / (NN + 1)
+    K = rgb2gray(K)
+    K = zero_mean_total(K)
+    K = wiener_dft(K, K.std(ddof=1)).astype(np.float32)
 
-    h, w, ch = imgs[0].shape
+    return K
 
-    RPsum = np.zeros((h, w, ch), np.float32)
-    NN = np.zeros((h, w, ch), np.float32)
 
-    if processes is None or processes > 1:
-        args_list = []
-        for im in imgs:
-            args_list += [(im, levels, sigma)]
-        pool = Pool(processes)
+class PRNUAccumulator:
+    """
+    Running sums of residuals (RPsum) and intensity/saturation weights (NN) of the images
+    contributing to a PRNU, so that images can be added one at a time.
+    The state can be saved together with the list of contributing images, so that a PRNU
+    can later be updated with new images only. A loaded state reads its sums only when they are first used,
+    so the lists of images of many saved accumulators can be inspected without keeping their sums in memory
+    """
 
-        for batch_idx0 in tqdm(np.arange(start=0, step=batch_size, stop=len(imgs)), disable=tqdm_str == '',
-                               desc=(tqdm_str + ' (1/2)'), dynamic_ncols=True):
-            # print(batch_idx0, batch_size)
-            nni = pool.map(inten_sat_compact, args_list[batch_idx0:batch_idx0 + batch_size])
-            for ni in nni:
-                NN += ni
-            del nni
+    def __init__(self, levels: int = 4, sigma: float = 5):
+        """
+        :param levels: number of wavelet decomposition levels of the accumulated residuals
+        :param sigma: estimated noise power of the accumulated residuals
+        """
+        self.levels = levels
+        self.sigma = sigma
+        self._RPsum = None
+        self._NN = None
+        self._sums_path = None
+        self.count = 0
+        self.files = []
+        self.skipped = []
+
+    def _load_sums(self):
+        if self._sums_path is not None:
+            with np.load(self._sums_path) as state:
+                self._RPsum = state['RPsum']
+                self._NN = state['NN']
+            self._sums_path = None
+
+    @property
+    def RPsum(self) -> np.ndarray:
+        self._load_sums()
+        return self._RPsum
+
+    @RPsum.setter
+    def RPsum(self, value: np.ndarray):
+        self._sums_path = None
+        self._RPsum = value
+
+    @property
+    def NN(self) -> np.ndarray:
+        self._load_sums()
+        return self._NN
+
+    @NN.setter
+    def NN(self, value: np.ndarray):
+        self._sums_path = None
+        self._NN = value
+
+    def add(self, wi: np.ndarray, ni: np.ndarray, item=None) -> bool:
+        """
+        Add the contribution of an image
+        :param wi: residual multiplied by the image, as from noise_extract_compact
+        :param ni: intensity scale and saturation, as from inten_sat_compact
+        :param item: reference of the image (e.g. its path), recorded in files
+        :return: False if the image size does not match the previous ones
+        """
+        if self.RPsum is None:
+            self.RPsum = np.zeros(wi.shape, np.float32)
+            self.NN = np.zeros(ni.shape, np.float32)
+        elif wi.shape != self.RPsum.shape:
+            self.skip(item)
+            return False
+        self.RPsum += wi
+        self.NN += ni
+        self.count += 1
+        if item is not None:
+            self.files.append(item)
+        return True
+
+    def skip(self, item=None):
+        """
+        Record an image which does not contribute to the PRNU, so that it is not processed again
+        :param item: reference of the image (e.g. its path)
+        """
+        if item is not None:
+            self.skipped.append(item)
+
+    def seen(self) -> set:
+        """
+        :return: references of the images already added or skipped
+        """
+        return set(self.files) | set(self.skipped)
+
+    def save(self, path: str):
+        """
+        Save the state to a .npz file. The file is replaced atomically, so an interrupted run leaves the previous state
+        :param path: destination path
+        """
+        tmp_path = path + '.tmp.npz'
+        state = dict(levels=self.levels, sigma=self.sigma, count=self.count,
+                     files=np.array(self.files, dtype=str), skipped=np.array(self.skipped, dtype=str))
+        if self.RPsum is not None:
+            state.update(RPsum=self.RPsum, NN=self.NN)
+        np.savez(tmp_path, **state)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, levels: int = 4, sigma: float = 5):
+        """
+        Load a state saved by save
+        :param path: .npz file
+        :param levels: number of wavelet decomposition levels of the residuals to be added
+        :param sigma: estimated noise power of the residuals to be added
+        :return: the saved accumulator, an empty one if the file is missing or was computed with other parameters.
+                 RPsum and NN are read from the file when first used
+        """
+        acc = cls(levels, sigma)
+        if not os.path.exists(path):
+            return acc
+        with np.load(path) as state:
+            if int(state['levels']) != levels or float(state['sigma']) != sigma:
+                print('Discarding {}: computed with levels={}, sigma={}'.format(path, int(state['levels']),
+                                                                                float(state['sigma'])))
+                return acc
+            if 'RPsum' in state:
+                acc._sums_path = path
+            acc.count = int(state['count'])
+            acc.files = state['files'].tolist()
+            acc.skipped = state['skipped'].tolist()
+        return acc
+
+    def fingerprint(self) -> np.ndarray:
+        """
+        :return: PRNU, None if no image was added
+        """
+        if self.RPsum is None:
+            return None
+        return finalize_fingerprint(self.RPsum, self.NN)
+
+
+def load_and_extract_compact(args):
+    """
+    Load an image and extract its residual and intensity/saturation contributions. Useful for multiprocessing,
+    since only the image reference is sent to the worker
+    :param args: (item, loader, levels, sigma, tile_size): loader(item) returns an image of type np.uint8 or None.
+                 If loader is None, item is the image itself. See noise_extract_compact for tile_size
+    :return: (residual multiplied by the image, intensity scale and saturation), None if the image was discarded
+    """
+    item, loader, levels, sigma, tile_size = args
+    im = item if loader is None else loader(item)
+    if im is None:
+        return None
+    return noise_inten_sat_compact((im, levels, sigma, tile_size))
 
-        for batch_idx0 in tqdm(np.arange(start=0, step=batch_size, stop=len(imgs)), disable=tqdm_str == '',
-                               desc=(tqdm_str + ' (2/2)'), dynamic_ncols=True):
-            wi_list = pool.map(noise_extract_compact, args_list[batch_idx0:batch_idx0 + batch_size])
-            for wi in wi_list:
-                RPsum += wi
-            del wi_list
 
-        pool.close()
+def bounded_imap(pool, func, iterable, window: int):
+    """
+    Ordered pool.imap keeping at most window tasks in flight.
+    Unlike pool.imap, the iterable is consumed only as results are collected
+    :param pool: multiprocessing pool
+    :param func: function to apply
+    :param iterable: arguments
+    :param window: maximum number of pending tasks
+    :return: generator of results
+    """
+    pending = deque()
+    for args in iterable:
+        pending.append(pool.apply_async(func, (args,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
+
+def stream_contributions(items, loader=None, levels: int = 4, sigma: float = 5, processes: int = None,
+                         window: int = None, tqdm_str: str = '', tile_size: int = None, pool=None):
+    """
+    Load images and extract their contributions to the PRNU, with at most window images in flight
+    :param items: iterable of images of type np.uint8, or of references (e.g. paths) to be read by loader
+    :param loader: picklable function returning an image of type np.uint8 (or None to discard it) from an item
+    :param levels: number of wavelet decomposition levels
+    :param sigma: estimated noise power
+    :param processes: number of parallel processes
+    :param window: maximum number of images in flight, defaults to twice the number of processes
+    :param tqdm_str: tqdm description (see tqdm documentation)
+    :param tile_size: if not None, residuals are extracted by tiles of this size, see noise_extract_tiled
+    :param pool: multiprocessing pool to be used, left open. By default a pool of processes is created and closed
+    :return: generator of load_and_extract_compact results, in the order of items
+    """
+    items = iter(items)
+    end = object()
+    first = next(items, end)
+    if first is end:
+        # Nothing to process: no pool is started
+        return
+    args_iter = ((item, loader, levels, sigma, tile_size) for item in chain([first], items))
+
+    own_pool = None
+    if pool is None and (processes is None or processes > 1):
+        pool = own_pool = Pool(processes)
+
+    if pool is not None:
+        if window is None:
+            window = 2 * (processes or cpu_count())
+        results = bounded_imap(pool, load_and_extract_compact, args_iter, window)
     else:  # Single process
-        for im in tqdm(imgs, disable=tqdm_str is None, desc=tqdm_str, dynamic_ncols=True):
-            RPsum += noise_extract_compact((im, levels, sigma))
-            NN += (inten_scale(im) * saturation(im)) ** 2
+        results = map(load_and_extract_compact, args_iter)
+
+    try:
+        yield from tqdm(results, disable=tqdm_str == '', desc=tqdm_str, dynamic_ncols=True)
+    except BaseException:
+        # The consumer stopped early (GeneratorExit) or failed
+        if own_pool is not None:
+            shutdown_pool(own_pool, completed=False)
+        raise
+    else:
+        if own_pool is not None:
+            shutdown_pool(own_pool, completed=True)
 
-    K = RPsum / (NN + 1)
-    K = rgb2gray(K)
-    K = zero_mean_total(K)
-    K = wiener_dft(K, K.std(ddof=1)).astype(np.float32)
 
-    return K
+def shutdown_pool(pool, completed: bool):
+    """
+    Stop a pool of processes and wait for its workers
+    :param pool: multiprocessing pool
+    :param completed: True if all the results were collected, so the workers exit when idle.
+                      Otherwise the tasks still queued or running are dropped
+    """
+    if completed:
+        pool.close()
+    else:
+        pool.terminate()
+    pool.join()
+
+
+def extract_multiple_streaming(items, loader=None, levels: int = 4, sigma: float = 5, processes: int = None,
+                               window: int = None, tqdm_str: str = '', tile_size: int = None) -> tuple:
+    """
+    Extract PRNU from a stream of images. Images are loaded, residual-extracted and accumulated as they arrive,
+    with at most window images in flight, so peak memory does not depend on the number of images.
+    Images are supposed to be properly oriented
+    :param items: iterable of images of type np.uint8, or of references (e.g. paths) to be read by loader
+    :param loader: picklable function returning an image of type np.uint8 (or None to discard it) from an item
+    :param levels: number of wavelet decomposition levels
+    :param sigma: estimated noise power
+    :param processes: number of parallel processes
+    :param window: maximum number of images in flight, defaults to twice the number of processes
+    :param tqdm_str: tqdm description (see tqdm documentation)
+    :param tile_size: if not None, residuals are extracted by tiles of this size, see noise_extract_tiled
+    :return: (PRNU or None if no image was accumulated, number of accumulated images)
+    """
+    acc = PRNUAccumulator()
+
+    for result in stream_contributions(items, loader, levels, sigma, processes, window, tqdm_str, tile_size):
+        if result is None:
+            continue
+        if not acc.add(*result):
+            print('Skipping image of size {}, expected {}'.format(result[0].shape, acc.RPsum.shape))
+
+    return acc.fingerprint(), acc.count
+
+
+def resume_accumulators(splits: dict, accumulators: dict = None, levels: int = 4, sigma: float = 5) -> dict:
+    """
+    Accumulators of the splits of a device, resumed when possible
+    :param splits: {split name: list of references (e.g. paths) of the images}
+    :param accumulators: {split name: PRNUAccumulator} to resume from, as from PRNUAccumulator.load.
+                         Accumulators containing images which are no longer in their split are restarted
+    :param levels: number of wavelet decomposition levels
+    :param sigma: estimated noise power
+    :return: {split name: PRNUAccumulator}
+    """
+    accs = {}
+    for name, items in splits.items():
+        acc = (accumulators or {}).get(name)
+        if acc is None or not acc.seen() <= set(items):
+            if acc is not None and acc.count:
+                print('Restarting {}: some of its images were removed'.format(name))
+            acc = PRNUAccumulator(levels, sigma)
+        accs[name] = acc
+    return accs
+
+
+def finalize_splits(accs: dict) -> dict:
+    """
+    :param accs: {split name: PRNUAccumulator}
+    :return: {split name: (PRNU or None if no image was accumulated, number of accumulated images)}
+    """
+    return {name: (acc.fingerprint(), acc.count) for name, acc in accs.items()}
+
+
+def extract_multiple_devices(devices: dict, loader=None, levels: int = 4, sigma: float = 5, processes: int = None,
+                             window: int = None, tqdm_str: str = '', accumulators: dict = None,
+                             checkpoint=None, checkpoint_every: int = 50, tile_size: int = None,
+                             finalize_threads: int = 2, pool=None):
+    """
+    Extract the PRNUs of the splits of several devices, keeping one pool of processes busy for the whole run.
+    The images of all the devices go through the same window of tasks, so the workers load and extract the images
+    of the next device while the last ones of the previous device are still in flight. Devices are finalized by a
+    thread pool as soon as their last image is accumulated, while the extraction goes on.
+    Within a device, the images shared by several splits are processed only once (see extract_multiple_splits)
+    :param devices: {device: {split name: list of references (e.g. paths) to be read by loader}}
+    :param loader: picklable function returning an image of type np.uint8 (or None to discard it) from a reference
+    :param levels: number of wavelet decomposition levels
+    :param sigma: estimated noise power
+    :param processes: number of parallel processes
+    :param window: maximum number of images in flight, defaults to twice the number of processes
+    :param tqdm_str: tqdm description (see tqdm documentation)
+    :param accumulators: {device: {split name: PRNUAccumulator}} to resume from, see resume_accumulators,
+                         or a function returning them from a device. Their sums are read (see PRNUAccumulator.load)
+                         when the first image of the device is accumulated, or when the device is finalized
+    :param checkpoint: function called with (device, {split name: PRNUAccumulator}) every checkpoint_every processed
+                       images of the device and when the device is completed, e.g. to save the accumulators.
+                       Only the splits changed since the previous checkpoint of the device are passed
+    :param checkpoint_every: number of processed images of a device between two checkpoints
+    :param tile_size: if not None, residuals are extracted by tiles of this size, see noise_extract_tiled
+    :param finalize_threads: number of devices finalized concurrently, at most twice as many are queued
+    :param pool: multiprocessing pool to be used, left open. By default a pool of processes is created and closed
+    :return: generator of (device, {split name: (PRNU or None if no image was accumulated, number of accumulated
+             images)}), in order of completion
+    """
+    accs = {}
+    tasks = []
+    remaining = {}
+    for device, splits in devices.items():
+        saved = accumulators(device) if callable(accumulators) else (accumulators or {}).get(device)
+        accs[device] = resume_accumulators(splits, saved, levels, sigma)
+
+        memberships = {}
+        for name, items in splits.items():
+            seen = accs[device][name].seen()
+            for item in items:
+                if item not in seen:
+                    memberships.setdefault(item, []).append(name)
+        tasks += [(device, item, names) for item, names in memberships.items()]
+        remaining[device] = len(memberships)
+
+    processed = dict.fromkeys(devices, 0)
+    # Splits changed since the last checkpoint of each device
+    changed = {device: set() for device in devices}
+
+    own_pool = None
+    if pool is None and tasks and (processes is None or processes > 1):
+        pool = own_pool = Pool(processes)
+
+    with ThreadPoolExecutor(finalize_threads) as finalizer:
+        futures = {}
+
+        def collect(timeout=0):
+            done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield futures.pop(future), future.result()
+
+        def checkpoint_changed(device):
+            if checkpoint is not None and changed[device]:
+                checkpoint(device, {name: accs[device][name] for name in changed[device]})
+            changed[device].clear()
+
+        def device_completed(device):
+            checkpoint_changed(device)
+            # Queued devices hold their accumulators until finalized
+            while len(futures) >= 2 * finalize_threads:
+                yield from collect(timeout=None)
+            futures[finalizer.submit(finalize_splits, accs.pop(device))] = device
+
+        try:
+            for device in devices:
+                if not remaining[device]:
+                    yield from device_completed(device)
+
+            results = stream_contributions((item for _, item, _ in tasks), loader, levels, sigma, processes, window,
+                                           tqdm_str, tile_size, pool)
+            for (device, item, names), result in zip(tasks, results):
+                device_accs = accs[device]
+                for name in names:
+                    if result is None:
+                        device_accs[name].skip(item)
+                    elif not device_accs[name].add(*result, item=item):
+                        print('Skipping {} of size {} for {}, expected {}'.format(item, result[0].shape, name,
+                                                                                  device_accs[name].RPsum.shape))
+                changed[device].update(names)
+                processed[device] += 1
+                remaining[device] -= 1
+                if not remaining[device]:
+                    yield from device_completed(device)
+                elif processed[device] % checkpoint_every == 0:
+                    checkpoint_changed(device)
+
+                yield from collect()
+        except BaseException:
+            # The consumer stopped early (GeneratorExit) or failed
+            if own_pool is not None:
+                shutdown_pool(own_pool, completed=False)
+            raise
+        else:
+            if own_pool is not None:
+                shutdown_pool(own_pool, completed=True)
+
+        while futures:
+            yield from collect(timeout=None)
+
+
+def extract_multiple_splits(splits: dict, loader=None, levels: int = 4, sigma: float = 5, processes: int = None,
+                            window: int = None, tqdm_str: str = '', accumulators: dict = None,
+                            checkpoint=None, checkpoint_every: int = 50, tile_size: int = None, pool=None) -> dict:
+    """
+    Extract the PRNUs of several (possibly overlapping) splits of the same images with a single pass:
+    the contributions of each image are computed once and added to every split containing it.
+    Splits can resume from previously saved accumulators, in which case only their new images are processed
+    :param splits: {split name: list of references (e.g. paths) to be read by loader}
+    :param loader: picklable function returning an image of type np.uint8 (or None to discard it) from a reference
+    :param levels: number of wavelet decomposition levels
+    :param sigma: estimated noise power
+    :param processes: number of parallel processes
+    :param window: maximum number of images in flight, defaults to twice the number of processes
+    :param tqdm_str: tqdm description (see tqdm documentation)
+    :param accumulators: {split name: PRNUAccumulator} to resume from, see resume_accumulators
+    :param checkpoint: function called with {split name: PRNUAccumulator} every checkpoint_every processed images
+                       and at the end, e.g. to save the accumulators. Only the splits changed since the previous
+                       checkpoint are passed
+    :param checkpoint_every: number of processed images between two checkpoints
+    :param tile_size: if not None, residuals are extracted by tiles of this size, see noise_extract_tiled
+    :param pool: multiprocessing pool to be used, left open. By default a pool of processes is created and closed
+    :return: {split name: (PRNU or None if no image was accumulated, number of accumulated images)}
+    """
+    device_checkpoint = None if checkpoint is None else lambda device, accs: checkpoint(accs)
+
+    return dict(extract_multiple_devices({None: splits}, loader, levels, sigma, processes, window, tqdm_str,
+                                         {None: accumulators}, device_checkpoint, checkpoint_every, tile_size,
+                                         finalize_threads=1, pool=pool))[None]
 
 
 def cut_ctr(array: np.ndarray, sizes: tuple) -> np.ndarray:
@@ -308,29 +760,61 @@ def wiener_adaptive(x: np.ndarray, noise_var: float, **kwargs) -> np.ndarray:
     Wiener adaptive flter aimed at extracting the noise component
     For each input pixel the average variance over a neighborhoods of different window sizes is first computed.
     The smaller average variance is taken into account when filtering according to Wiener.
-    :param x: 2D matrix
+    Averages are box sums of a single integral image, shared by all the window sizes, and only their running minimum
+    is kept. The threshold is monotone, so it is applied once to the minimum
+    :param x: 2D matrix, or stack of 2D matrices along the trailing axes (H,W,...), filtered independently
     :param noise_var: Power spectral density of the noise we wish to extract (S)
     :param window_size_list: list of window sizes
     :return: wiener filtered version of input x
     """
     window_size_list = list(kwargs.pop('window_size_list', [3, 5, 7, 9]))
 
-    energy = x ** 2
-
-    avg_win_energy = np.zeros(x.shape + (len(window_size_list),))
-    for window_idx, window_size in enumerate(window_size_list):
-        avg_win_energy[:, :, window_idx] = filters.uniform_filter(energy,
-                                                                  window_size,
-                                                                  mode='constant')
-
-    coef_var = threshold(avg_win_energy, noise_var)
-    coef_var_min = np.min(coef_var, axis=2)
+    h, w = x.shape[:2]
+    margin = max(window_size_list) // 2
+
+    # Integral image of the zero padded energy (uniform_filter with mode='constant'), with a leading row and column of 0
+    integral = np.zeros((h + 2 * margin + 1, w + 2 * margin + 1) + x.shape[2:], np.float64)
+    np.square(x, out=integral[margin + 1:margin + 1 + h, margin + 1:margin + 1 + w], dtype=np.float64)
+    np.cumsum(integral, axis=0, out=integral)
+    np.cumsum(integral, axis=1, out=integral)
+
+    box_sum = np.empty(x.shape, np.float64)
+    avg_win_energy_min = None
+    for window_size in window_size_list:
+        r0 = margin - window_size // 2
+        r1 = r0 + window_size
+        np.subtract(integral[r1:r1 + h, r1:r1 + w], integral[r0:r0 + h, r1:r1 + w], out=box_sum)
+        box_sum -= integral[r1:r1 + h, r0:r0 + w]
+        box_sum += integral[r0:r0 + h, r0:r0 + w]
+        box_sum /= window_size ** 2
+        if avg_win_energy_min is None:
+            avg_win_energy_min = box_sum.astype(np.float32)
+        else:
+            np.minimum(avg_win_energy_min, box_sum, out=avg_win_energy_min, casting='unsafe')
+    del integral, box_sum
+
+    coef_var_min = threshold(avg_win_energy_min, noise_var)
 
     x = x * noise_var / (coef_var_min + noise_var)
 
     return x
 
 
+def inten_scale_lut(T: int = 252, v: float = 6) -> np.ndarray:
+    """
+    IntenScale as from Binghamton toolbox, for every uint8 value
+    :param T: intensity above which pixels are attenuated
+    :param v: attenuation spread
+    :return: lookup table of 256 values
+    """
+    levels = np.arange(256, dtype=np.float64)
+    return np.where(levels < T, levels / T, np.exp(-(levels - T) ** 2 / v))
+
+
+INTEN_SCALE_LUT = inten_scale_lut()
+INTEN_SCALE_SQUARED_LUT = (INTEN_SCALE_LUT ** 2).astype(np.float32)
+
+
 def inten_scale(im: np.ndarray) -> np.ndarray:
     """
     IntenScale as from Binghamton toolbox
@@ -340,17 +824,35 @@ def inten_scale(im: np.ndarray) -> np.ndarray:
 
     assert (im.dtype == np.uint8)
 
-    T = 252
-    v = 6
-    # print(im, v, T)
-    arg = (-((im-T)**2))/ v
-    # print(arg)
-    out = np.exp(arg)
-    # out = np.exp(-1 * (im - T) ** 2 / v)
-    
-    out[im < T] = im[im < T] / T
-    
-    return out
+    return INTEN_SCALE_LUT[im]
+
+
+def equal_neighbor(im: np.ndarray) -> np.ndarray:
+    """
+    Pixels equal to at least one of their 4 neighbors, with circular boundaries
+    :param im: 3D matrix (H,W,Ch)
+    :return: boolean map of the same size
+    """
+    eq = np.empty(im.shape, bool)
+
+    # Horizontal neighbors: pair (j, j+1) marks both pixels, the circular pair (W-1, 0) both edges
+    pair = im[:, 1:] == im[:, :-1]
+    eq[:, :-1] = pair
+    eq[:, -1] = False
+    np.logical_or(eq[:, 1:], pair, out=eq[:, 1:])
+    pair = im[:, 0] == im[:, -1]
+    eq[:, 0] |= pair
+    eq[:, -1] |= pair
+
+    # Vertical neighbors
+    pair = im[1:] == im[:-1]
+    eq[:-1] |= pair
+    np.logical_or(eq[1:], pair, out=eq[1:])
+    pair = im[0] == im[-1]
+    eq[0] |= pair
+    eq[-1] |= pair
+
+    return eq
 
 
 def saturation(im: np.ndarray) -> np.ndarray:
@@ -361,39 +863,25 @@ def saturation(im: np.ndarray) -> np.ndarray:
     """
     assert (im.dtype == np.uint8)
 
-    if im.ndim == 2:
-        im.shape += (1,)
+    im3 = im[:, :, None] if im.ndim == 2 else im
 
-    h, w, ch = im.shape
-
-    if im.max() < 250:
-        return np.ones((h, w, ch))
+    max_ch = im3.max(axis=0).max(axis=0)
 
-    im_h = im - np.roll(im, (0, 1), (0, 1))
-    im_v = im - np.roll(im, (1, 0), (0, 1))
-    satur_map = \
-        np.bitwise_not(
-            np.bitwise_and(
-                np.bitwise_and(
-                    np.bitwise_and(
-                        im_h != 0, im_v != 0
-                    ), np.roll(im_h, (0, -1), (0, 1)) != 0
-                ), np.roll(im_v, (-1, 0), (0, 1)) != 0
-            )
-        )
+    if max_ch.max() < 250:
+        return np.ones(im.shape)
 
-    max_ch = im.max(axis=0).max(axis=0)
+    satur_map = equal_neighbor(im3)
 
     for ch_idx, max_c in enumerate(max_ch):
         if max_c > 250:
             satur_map[:, :, ch_idx] = \
                 np.bitwise_not(
                     np.bitwise_and(
-                        im[:, :, ch_idx] == max_c, satur_map[:, :, ch_idx]
+                        im3[:, :, ch_idx] == max_c, satur_map[:, :, ch_idx]
                     )
                 )
 
-    return satur_map
+    return satur_map.reshape(im.shape)
 
 
 def inten_sat_compact(args):
@@ -403,4 +891,8 @@ def inten_sat_compact(args):
     :return: intensity scale and saturation of input
     """
     im = args[0]
-    return ((inten_scale(im) * saturation(im)) ** 2).astype(np.float32)
\ No newline at end of file
+    out = INTEN_SCALE_SQUARED_LUT[im]
+    satur_map = saturation(im)
+    if satur_map.dtype == bool:
+        out *= satur_map
+    return out
\ No newline at end of file
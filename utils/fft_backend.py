@@ -0,0 +1,101 @@
+from scipy.fft import next_fast_len
+import scipy.fft
+import numpy as np
+import os
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.numpy_fft
+except ImportError:
+    pyfftw = None
+
+"""
+FFT backend of the correlation, CCN, Wiener-DFT and WPSNR code, selectable at runtime with set_backend:
+ - numpy: numpy.fft
+ - scipy: scipy.fft, multithreaded with workers (plans are cached by pocketfft)
+ - pyfftw: FFTW through pyFFTW if installed, with plans cached per shape and type
+scipy and pyfftw keep the precision of their input: float32 inputs give complex64 spectra.
+numpy.fft does so from numpy 2.0 only, older versions always compute and return double precision.
+"""
+
+BACKENDS = ['numpy', 'scipy', 'pyfftw']
+
+# Seconds after which unused pyFFTW plans are released
+PYFFTW_CACHE_KEEPALIVE = 60
+
+# Worker processes of the pools run one FFT thread each by default
+_backend = 'scipy'
+_workers = 1
+
+
+def set_backend(name: str, workers: int = 1):
+    """
+    :param name: one of BACKENDS
+    :param workers: number of threads per transform (scipy and pyfftw), -1 for all the CPUs
+    :raise ValueError: if the backend is unknown or not installed
+    """
+    global _backend, _workers
+    if name not in BACKENDS:
+        raise ValueError('Unknown FFT backend {}, expected one of {}'.format(name, BACKENDS))
+    if name == 'pyfftw':
+        if pyfftw is None:
+            raise ValueError('pyFFTW is not installed')
+        pyfftw.interfaces.cache.enable()
+        pyfftw.interfaces.cache.set_keepalive_time(PYFFTW_CACHE_KEEPALIVE)
+    _backend = name
+    _workers = workers
+
+
+def get_backend() -> tuple:
+    """
+    :return: (backend name, number of threads per transform)
+    """
+    return _backend, _workers
+
+
+def _module():
+    """
+    :return: (FFT module, keyword arguments selecting the number of threads)
+    """
+    if _backend == 'scipy':
+        return scipy.fft, {'workers': _workers}
+    if _backend == 'pyfftw':
+        return pyfftw.interfaces.numpy_fft, {'threads': os.cpu_count() if _workers == -1 else _workers}
+    return np.fft, {}
+
+
+def fft2(x: np.ndarray, s: tuple = None, axes: tuple = (-2, -1)) -> np.ndarray:
+    module, kwargs = _module()
+    return module.fft2(x, s=s, axes=axes, **kwargs)
+
+
+def ifft2(x: np.ndarray, s: tuple = None, axes: tuple = (-2, -1)) -> np.ndarray:
+    module, kwargs = _module()
+    return module.ifft2(x, s=s, axes=axes, **kwargs)
+
+
+def rfft2(x: np.ndarray, s: tuple = None, axes: tuple = (-2, -1)) -> np.ndarray:
+    """
+    FFT of a real input, only the non-negative frequencies of the last axis are computed
+    """
+    module, kwargs = _module()
+    return module.rfft2(x, s=s, axes=axes, **kwargs)
+
+
+def irfft2(x: np.ndarray, s: tuple = None, axes: tuple = (-2, -1)) -> np.ndarray:
+    """
+    Inverse of rfft2. s should be given, the length of the last axis can not be recovered from the spectrum
+    """
+    module, kwargs = _module()
+    return module.irfft2(x, s=s, axes=axes, **kwargs)
+
+
+def rfft(x: np.ndarray, n: int = None) -> np.ndarray:
+    module, kwargs = _module()
+    return module.rfft(x, n=n, **kwargs)
+
+
+def irfft(x: np.ndarray, n: int = None) -> np.ndarray:
+    module, kwargs = _module()
+    return module.irfft(x, n=n, **kwargs)
+
@@ -0,0 +1,182 @@
+from collections import namedtuple
+import numpy as np
+import glob
+import json
+import os
+
+"""
+Packed fingerprint storage.
+All the fingerprints of a split are stored in a single raw file, described by a JSON index
+(device, shape, dtype, offset, split, number of source images). Fingerprints are opened as read-only
+memory maps, so loading them costs page-cache reads instead of private copies.
+Worker processes receive a FingerprintRef and open the store themselves, sharing the same pages.
+"""
+
+STORE_DATA = 'fingerprints.dat'
+STORE_INDEX = 'index.json'
+
+# Offsets of the fingerprints in the data file are aligned to this number of bytes
+ALIGNMENT = 64
+
+# Reference to a fingerprint, as passed to worker processes
+FingerprintRef = namedtuple('FingerprintRef', ['folder', 'device'])
+
+
+def device_name(fingerprint_file: str) -> str:
+    """
+    :param fingerprint_file: path of a fingerprint .npy file, as Fingerprint_D08.npy
+    :return: name of the device, as D08
+    """
+    return os.path.basename(fingerprint_file)[len('Fingerprint_'):-len('.npy')]
+
+
+class FingerprintStore:
+    """
+    Read-only view of the fingerprints of a split, packed by pack_fingerprints
+    """
+
+    def __init__(self, folder: str):
+        """
+        :param folder: split folder, containing the data and index files
+        :raise FileNotFoundError: if the folder contains no store
+        """
+        self.folder = folder
+        self.mtime = os.path.getmtime(os.path.join(folder, STORE_INDEX))
+        with open(os.path.join(folder, STORE_INDEX), 'r') as f:
+            index = json.load(f)
+        self.split = index['split']
+        self.entries = index['fingerprints']
+        self._data = None
+
+    def _memmap(self) -> np.memmap:
+        if self._data is None:
+            self._data = np.memmap(os.path.join(self.folder, STORE_DATA), dtype=np.uint8, mode='r')
+        return self._data
+
+    def devices(self) -> list:
+        return list(self.entries)
+
+    def __contains__(self, device: str) -> bool:
+        return device in self.entries
+
+    def count(self, device: str) -> int:
+        """
+        :param device: name of the device, as D08
+        :return: number of images the fingerprint was estimated from, None if unknown
+        """
+        return self.entries[device]['count']
+
+    def get(self, device: str) -> np.ndarray:
+        """
+        :param device: name of the device, as D08
+        :return: read-only fingerprint, in the stored type
+        """
+        entry = self.entries[device]
+        dtype = np.dtype(entry['dtype'])
+        size = int(np.prod(entry['shape'])) * dtype.itemsize
+        data = self._memmap()[entry['offset']:entry['offset'] + size]
+        return data.view(dtype).reshape(entry['shape'])
+
+
+def pack_fingerprints(folder: str, dtype: type = np.float32) -> FingerprintStore:
+    """
+    Pack the Fingerprint_D*.npy files of a split folder into a store. Files are replaced atomically,
+    so readers see either the previous store or the new one
+    :param folder: split folder, e.g. fingerprints/evaluation
+    :param dtype: stored type, np.float32 or np.float16 (half the size, about 3 significant digits)
+    :return: the new store
+    """
+    dtype = np.dtype(dtype)
+    entries = {}
+    data_tmp = os.path.join(folder, STORE_DATA + '.tmp')
+    index_tmp = os.path.join(folder, STORE_INDEX + '.tmp')
+
+    with open(data_tmp, 'wb') as data:
+        for fingerprint_file in sorted(glob.glob(os.path.join(folder, 'Fingerprint_D*.npy'))):
+            fingerprint = np.load(fingerprint_file, mmap_mode='r')
+            device = device_name(fingerprint_file)
+
+            # Number of source images, as recorded by the accumulator of the estimation
+            count = None
+            acc_file = fingerprint_file[:-len('.npy')] + '.acc.npz'
+            if os.path.exists(acc_file):
+                with np.load(acc_file) as state:
+                    count = int(state['count'])
+
+            data.write(b'\0' * (-data.tell() % ALIGNMENT))
+            entries[device] = {'shape': list(fingerprint.shape), 'dtype': dtype.str, 'offset': data.tell(),
+                               'split': os.path.basename(os.path.normpath(folder)), 'count': count}
+            data.write(np.ascontiguousarray(fingerprint, dtype=dtype).tobytes())
+
+    with open(index_tmp, 'w') as f:
+        json.dump({'split': os.path.basename(os.path.normpath(folder)), 'fingerprints': entries}, f, indent=4)
+
+    os.replace(data_tmp, os.path.join(folder, STORE_DATA))
+    os.replace(index_tmp, os.path.join(folder, STORE_INDEX))
+
+    return FingerprintStore(folder)
+
+
+_stores = {}
+
+
+def open_store(folder: str):
+    """
+    Store of a split folder, reopened only when its index changes
+    :param folder: split folder
+    :return: FingerprintStore, None if the folder contains no store
+    """
+    index_file = os.path.join(folder, STORE_INDEX)
+    try:
+        mtime = os.path.getmtime(index_file)
+    except OSError:
+        return None
+    store, store_mtime = _stores.get(folder, (None, None))
+    if store is None or store_mtime != mtime:
+        store = FingerprintStore(folder)
+        _stores[folder] = (store, mtime)
+    return store
+
+
+def load_fingerprint(folder: str, device: str) -> np.ndarray:
+    """
+    Load a fingerprint from the store of its split, falling back to its .npy file when the store does not contain it
+    or the .npy file is newer (e.g. saved by an estimation which did not pack the store yet).
+    Fingerprints are memory mapped and read-only; float16 fingerprints are converted to float32
+    :param folder: split folder, e.g. fingerprints/evaluation
+    :param device: name of the device, as D08
+    :return: 2D float32 fingerprint
+    :raise FileNotFoundError: if the fingerprint is neither in the store nor in its .npy file
+    """
+    fingerprint_file = os.path.join(folder, 'Fingerprint_' + device + '.npy')
+    store = open_store(folder)
+    if store is not None and device in store and not _newer(fingerprint_file, store.mtime):
+        fingerprint = store.get(device)
+    else:
+        fingerprint = np.load(fingerprint_file, mmap_mode='r')
+    return fingerprint.astype(np.float32, copy=False)
+
+
+def fingerprint_sources(fingerprint_file: str) -> list:
+    """
+    :param fingerprint_file: path of a fingerprint .npy file, as fingerprints/evaluation/Fingerprint_D08.npy
+    :return: files a fingerprint loaded by load_fingerprint may come from: the .npy file and the store index
+    """
+    return [fingerprint_file, os.path.join(os.path.dirname(fingerprint_file), STORE_INDEX)]
+
+
+def _newer(path: str, mtime: float) -> bool:
+    try:
+        return os.path.getmtime(path) > mtime
+    except OSError:
+        return False
+
+
+def resolve_fingerprint(fingerprint) -> np.ndarray:
+    """
+    :param fingerprint: FingerprintRef or array
+    :return: fingerprint, mapped from the store of its split for a FingerprintRef. Arrays are returned as they are
+    """
+    if isinstance(fingerprint, FingerprintRef):
+        return load_fingerprint(fingerprint.folder, fingerprint.device)
+    return fingerprint
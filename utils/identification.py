@@ -0,0 +1,74 @@
+from utils.cross_correlation import FingerprintSpectrum, probe_spectrum, crosscorr_spectra
+from utils.pce import correlation_stats
+import numpy as np
+import os
+
+"""
+Device identification functions
+"""
+
+
+class DeviceIdentifier:
+    """
+    Correlates a probe image with the fingerprints of many devices at once.
+    Fingerprints are loaded and transformed once, the probe is transformed once per
+    correlation map size, so each device only costs a spectrum product and an inverse FFT.
+    """
+
+    def __init__(self, fingerprint_files: dict, dtype: type = np.complex64):
+        """
+        :param fingerprint_files: {device: path of the 2D fingerprint .npy file or 2D array}.
+                                  Missing files are skipped
+        :param dtype: complex type of the stored spectra
+        """
+        self.dtype = dtype
+        self.fingerprints = {}
+        for device, fingerprint_file in fingerprint_files.items():
+            if isinstance(fingerprint_file, np.ndarray):
+                self.fingerprints[device] = fingerprint_file.astype(np.float32, copy=False)
+                continue
+            if not os.path.exists(fingerprint_file):
+                continue
+            self.fingerprints[device] = np.load(fingerprint_file).astype(np.float32)
+        self._spectra = {}
+
+    def spectrum(self, device, shape: tuple) -> FingerprintSpectrum:
+        """
+        :param device: key of the fingerprint
+        :param shape: (height, width) of the correlation map
+        :return: FingerprintSpectrum of the device fingerprint for the given map size
+        """
+        key = (device, shape)
+        if key not in self._spectra:
+            self._spectra[key] = FingerprintSpectrum(self.fingerprints[device], device=device, shape=shape,
+                                                     dtype=self.dtype)
+        return self._spectra[key]
+
+    def correlate_all(self, probe: np.ndarray, neigh_radius: int = 2, devices=None) -> dict:
+        """
+        PCE and peak position of a probe with every device fingerprint
+        :param probe: 3D matrix (H, W, C), properly oriented
+        :param neigh_radius: radius around the peak to be ignored while computing floor energy
+        :param devices: devices to be correlated, defaults to all of them
+        :return: {device: {'pce': PCE value, 'peak': [y, x] position of the peak}}
+        """
+        probe_ffts = {}
+        result = {}
+        for device in (self.fingerprints if devices is None else devices):
+            fingerprint = self.fingerprints[device]
+            shape = (max(probe.shape[0], fingerprint.shape[0]), max(probe.shape[1], fingerprint.shape[1]))
+            if shape not in probe_ffts:
+                probe_ffts[shape] = probe_spectrum(probe, shape).astype(self.dtype, copy=False)
+            cc = crosscorr_spectra(probe_ffts[shape], self.spectrum(device, shape))
+            stats = correlation_stats(cc, neigh_radius)
+            result[device] = {'pce': stats['pce'], 'peak': stats['peak']}
+        return result
+
+    def pce_all(self, probe: np.ndarray, neigh_radius: int = 2) -> dict:
+        """
+        PCE of a probe with every device fingerprint
+        :param probe: 3D matrix (H, W, C), properly oriented
+        :param neigh_radius: radius around the peak to be ignored while computing floor energy
+        :return: {device: PCE value}
+        """
+        return {device: value['pce'] for device, value in self.correlate_all(probe, neigh_radius).items()}
\ No newline at end of file
@@ -1,8 +1,29 @@
 import numpy as np
 
+# Values per block when summing squares: single precision dot products on blocks, accumulated in double precision
+ENERGY_BLOCK_SIZE = 1 << 16
+
+
+def energy(cc: np.ndarray) -> np.ndarray:
+    """
+    Sum of squares of 2D maps, without squaring a full copy
+    :param cc: 2D map (H, W) or stack of maps (N, H, W)
+    :return: energy, scalar or array of N values
+    """
+    stack = cc[np.newaxis] if cc.ndim == 2 else cc
+    rows = max(1, ENERGY_BLOCK_SIZE // max(1, stack.shape[2]))
+    total = np.zeros(stack.shape[0], np.float64)
+    for idx, cc_map in enumerate(stack):
+        for y0 in range(0, cc_map.shape[0], rows):
+            block = cc_map[y0:y0 + rows].ravel()
+            total[idx] += float(np.dot(block, block))
+    return total[0] if cc.ndim == 2 else total
+
+
 def pce_color(cc: np.ndarray, neigh_radius: int = 2) -> float:
     """
     Compute the PCE (Peak-to-Correlation-Energy) on the 2D cross-correlation map.
+    The floor energy is the total energy minus the energy of the neighborhood of the peak, so the map is not copied.
 
     :param cc: 2D cross-correlation map
     :param neigh_radius: radius around the peak to be ignored while computing floor energy
@@ -14,25 +35,85 @@ def pce_color(cc: np.ndarray, neigh_radius: int = 2) -> float:
     # Find global maximum
     max_idx = np.argmax(cc)
     max_y, max_x = np.unravel_index(max_idx, cc.shape)
-    peak_height = cc[max_y, max_x]
+    peak_height = float(cc[max_y, max_x])
 
-    # Create a copy to zero out the region around the peak
-    cc_nopeaks = cc.copy()
-    
-    # Safely zero-out the neighborhood around the peak
+    # Neighborhood of the peak, clipped to the map
     y1 = max(0, max_y - neigh_radius)
     y2 = min(cc.shape[0], max_y + neigh_radius + 1)
     x1 = max(0, max_x - neigh_radius)
     x2 = min(cc.shape[1], max_x + neigh_radius + 1)
-    cc_nopeaks[y1:y2, x1:x2] = 0
+    peak_energy = energy(cc[y1:y2, x1:x2])
 
-    # Compute the "floor" energy
-    pce_energy = np.mean(cc_nopeaks ** 2)
+    # Compute the "floor" energy, mean over the whole map with the neighborhood set to 0
+    pce_energy = (energy(cc) - peak_energy) / cc.size
 
     # Final PCE
     pce_value = (peak_height ** 2) / pce_energy * np.sign(peak_height)
     return pce_value
 
+
+def pce_batch(cc: np.ndarray, neigh_radius: int = 2) -> tuple:
+    """
+    PCE of a stack of 2D cross-correlation maps, as pce_color for each of them
+    :param cc: 3D matrix (N, H, W) of cross-correlation maps
+    :param neigh_radius: radius around the peak to be ignored while computing floor energy
+    :return: (PCE values (N,), peak positions (N, 2) as (y, x), signs of the peaks (N,))
+    """
+    assert (cc.ndim == 3)
+    assert (isinstance(neigh_radius, int))
+
+    n, h, w = cc.shape
+    max_idx = np.argmax(cc.reshape(n, -1), axis=1)
+    max_y, max_x = np.unravel_index(max_idx, (h, w))
+    peak_height = cc[np.arange(n), max_y, max_x].astype(np.float64)
+
+    # Neighborhoods of the peaks, the positions outside of the maps do not contribute
+    offsets = np.arange(-neigh_radius, neigh_radius + 1)
+    ys = max_y[:, None, None] + offsets[None, :, None]
+    xs = max_x[:, None, None] + offsets[None, None, :]
+    inside = (ys >= 0) & (ys < h) & (xs >= 0) & (xs < w)
+    window = cc[np.arange(n)[:, None, None], np.clip(ys, 0, h - 1), np.clip(xs, 0, w - 1)].astype(np.float64)
+    peak_energy = np.sum(np.where(inside, window, 0) ** 2, axis=(1, 2))
+
+    pce_energy = (energy(cc) - peak_energy) / (h * w)
+
+    signs = np.sign(peak_height)
+    pce_values = (peak_height ** 2) / pce_energy * signs
+    return pce_values, np.stack([max_y, max_x], axis=1), signs
+
+
+def correlation_stats(cc: np.ndarray, neigh_radius: int = 2) -> dict:
+    """
+    PCE, peak position and 2D CCN (Cross-Correlation Norm) of a 2D cross-correlation map, sharing one energy pass.
+    The PCE is as pce_color. The 2D CCN is the correlation at zero lag (the last row and column of the map) over
+    the root mean square of the map outside of the neighborhood of the zero lag, clipped to the map.
+    It is not the CCN of ccn_fft (1D correlation of the flattened images), and is reported as ccn_2d
+
+    :param cc: 2D cross-correlation map, as from crosscorr_2d_color
+    :param neigh_radius: radius around the peaks to be ignored while computing floor energy
+    :return: {'pce': PCE value, 'peak': [y, x] position of the peak, 'ccn_2d': 2D CCN value}
+    """
+    assert (cc.ndim == 2)
+    assert (isinstance(neigh_radius, int))
+
+    total_energy = energy(cc)
+
+    # PCE around the global maximum
+    max_y, max_x = np.unravel_index(np.argmax(cc), cc.shape)
+    peak_height = float(cc[max_y, max_x])
+    peak_window = cc[max(0, max_y - neigh_radius):max_y + neigh_radius + 1,
+                     max(0, max_x - neigh_radius):max_x + neigh_radius + 1]
+    pce_energy = (total_energy - energy(peak_window)) / cc.size
+    pce_value = (peak_height ** 2) / pce_energy * np.sign(peak_height)
+
+    # CCN around the zero lag
+    zero_window = cc[max(0, cc.shape[0] - 1 - neigh_radius):, max(0, cc.shape[1] - 1 - neigh_radius):]
+    ccn_energy = (total_energy - energy(zero_window)) / (cc.size - zero_window.size)
+    ccn_value = float(cc[-1, -1]) / np.sqrt(ccn_energy)
+
+    return {'pce': float(pce_value), 'peak': [int(max_y), int(max_x)], 'ccn_2d': float(ccn_value)}
+
+
 def pce(cc: np.ndarray, neigh_radius: int = 2):
     """
     PCE position and value
@@ -0,0 +1,219 @@
+from utils.constants import RESULT_CACHE_PATH, RESULT_CACHE_SIZE
+from hashlib import blake2b
+import numpy as np
+import json
+import os
+
+"""
+On-disk cache of results (PCE, CCN, peak positions, residuals), addressed by the content of their inputs:
+keys hash the bytes of the image file, the identity of the fingerprint and the parameters of the operation,
+so a result is reused as long as its inputs are unchanged, whatever their path, and never when they changed.
+Entries are small JSON files or .npy arrays; the least recently used ones are evicted above a size limit.
+"""
+
+_file_digests = {}
+_array_digests = {}
+
+
+def file_version(path: str) -> tuple:
+    """
+    :param path: file path
+    :return: (absolute path, modification time, size), with None for time and size if the file is missing
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return os.path.abspath(path), None, None
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+def file_digest(path: str) -> str:
+    """
+    Hash of the content of a file, computed once per process as long as the file is not modified
+    :param path: file path
+    :return: hex digest
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    digest = _file_digests.get(memo_key)
+    if digest is None:
+        h = blake2b(digest_size=20)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        digest = h.hexdigest()
+        _file_digests[memo_key] = digest
+    return digest
+
+
+def array_digest(array: np.ndarray, files=None) -> str:
+    """
+    Hash of the content of an array, e.g. the identity of a fingerprint
+    :param array: array
+    :param files: path or list of paths of the files the array was read from (e.g. the fingerprint file and the
+                  index of its store). If not None, the digest is computed once per process as long as
+                  these files are not modified
+    :return: hex digest
+    """
+    memo_key = None
+    if files is not None:
+        memo_key = tuple(file_version(path) for path in ([files] if isinstance(files, str) else files))
+        if memo_key in _array_digests:
+            return _array_digests[memo_key]
+    h = blake2b(digest_size=20)
+    h.update(str((array.shape, array.dtype.str)).encode())
+    h.update(np.ascontiguousarray(array).data)
+    digest = h.hexdigest()
+    if memo_key is not None:
+        _array_digests[memo_key] = digest
+    return digest
+
+
+def cache_key(*parts) -> str:
+    """
+    :param parts: digests and JSON serializable parameters identifying a result
+    :return: hex key
+    """
+    return blake2b(json.dumps(parts, sort_keys=True).encode(), digest_size=20).hexdigest()
+
+
+def correlation_key(image_file: str, orientation, fingerprint_id: str, neigh_radius: int = 2) -> str:
+    """
+    Key of the PCE and peak position of an image with a fingerprint
+    :param image_file: image path
+    :param orientation: EXIF orientation the image is aligned with
+    :param fingerprint_id: as from array_digest
+    :param neigh_radius: radius around the peak ignored by the PCE
+    :return: hex key
+    """
+    return cache_key('correlation', file_digest(image_file), orientation, fingerprint_id, neigh_radius)
+
+
+class ResultCache:
+    """
+    Content-addressed result cache, safe to share among processes: entries are written atomically
+    and a missing entry is only a miss
+    """
+
+    def __init__(self, path: str, max_bytes: int = 2 ** 31, evict_every: int = 100):
+        """
+        :param path: cache folder
+        :param max_bytes: size above which the least recently used entries are evicted
+        :param evict_every: number of writes between two size checks
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self._writes = 0
+
+    def _entry(self, key: str, ext: str) -> str:
+        return os.path.join(self.path, key[:2], key + ext)
+
+    def _read(self, entry: str, reader):
+        try:
+            value = reader(entry)
+        except (OSError, ValueError):
+            return None
+        # Reading an entry makes it the most recently used
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return value
+
+    def _write(self, entry: str, writer):
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp_entry = '{}.{}.tmp'.format(entry, os.getpid())
+        writer(tmp_entry)
+        os.replace(tmp_entry, entry)
+        self._writes += 1
+        if self._writes % self.evict_every == 0:
+            self.evict()
+
+    def get(self, key: str):
+        """
+        :param key: as from cache_key
+        :return: cached JSON value, None if missing
+        """
+        def reader(entry):
+            with open(entry, 'r') as f:
+                return json.load(f)
+        return self._read(self._entry(key, '.json'), reader)
+
+    def put(self, key: str, value):
+        """
+        :param key: as from cache_key
+        :param value: JSON serializable value
+        """
+        def writer(entry):
+            with open(entry, 'w') as f:
+                json.dump(value, f)
+        self._write(self._entry(key, '.json'), writer)
+
+    def get_array(self, key: str) -> np.ndarray:
+        """
+        :param key: as from cache_key
+        :return: cached array, None if missing
+        """
+        return self._read(self._entry(key, '.npy'), lambda entry: np.load(entry, allow_pickle=False))
+
+    def put_array(self, key: str, array: np.ndarray):
+        """
+        :param key: as from cache_key
+        :param array: array, e.g. a residual
+        """
+        def writer(entry):
+            with open(entry, 'wb') as f:
+                np.save(f, array)
+        self._write(self._entry(key, '.npy'), writer)
+
+    def get_or_compute(self, key: str, compute):
+        """
+        :param key: as from cache_key
+        :param compute: function computing the JSON serializable value on a miss
+        :return: cached or computed value
+        """
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes
+        """
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.path):
+            for file in files:
+                entry = os.path.join(root, file)
+                try:
+                    stat = os.stat(entry)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry))
+                total += stat.st_size
+
+        entries.sort()
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(entry)
+            except OSError:
+                continue
+            total -= size
+
+
+_result_cache = None
+
+
+def result_cache() -> ResultCache:
+    """
+    :return: the cache of the project, in RESULT_CACHE_PATH
+    """
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = ResultCache(RESULT_CACHE_PATH, RESULT_CACHE_SIZE)
+    return _result_cache
@@ -1,11 +1,186 @@
-import cv2
 import exiftool
+import struct
+import atexit
+import cv2
+import os
 
-def rotate_image(img, img_name):
+ORIENTATION_TAG = 0x0112
+
+def read_jpeg_orientation(img_name):
+    """
+    Read the EXIF Orientation tag from the APP1 segment of a JPEG file, without external processes
+    :param img_name: image path
+    :return: EXIF orientation, None if the file has no such tag
+    :raise ValueError: if the file can not be parsed (not a JPEG, truncated or malformed EXIF)
+    """
+    with open(img_name, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            raise ValueError('Not a JPEG file: {}'.format(img_name))
+
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xFF:
+                raise ValueError('Malformed JPEG segment in {}'.format(img_name))
+            # Fill bytes
+            while marker[1] == 0xFF:
+                marker = marker[1:] + f.read(1)
+                if len(marker) < 2:
+                    raise ValueError('Malformed JPEG segment in {}'.format(img_name))
+            # Start of scan or end of image: no EXIF in the headers
+            if marker[1] in (0xDA, 0xD9):
+                return None
+            # Markers without payload
+            if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD7:
+                continue
+
+            length_bytes = f.read(2)
+            if len(length_bytes) < 2:
+                raise ValueError('Truncated JPEG file: {}'.format(img_name))
+            length = struct.unpack('>H', length_bytes)[0] - 2
+            if marker[1] != 0xE1:
+                f.seek(length, os.SEEK_CUR)
+                continue
+
+            segment = f.read(length)
+            if len(segment) < length:
+                raise ValueError('Truncated JPEG file: {}'.format(img_name))
+            if segment[:6] != b'Exif\x00\x00':
+                # XMP or other APP1 payloads
+                continue
+            return _tiff_orientation(segment[6:], img_name)
+
+
+def _tiff_orientation(tiff, img_name):
+    """
+    Orientation tag of the IFD0 of a TIFF structure, as embedded in the EXIF APP1 segment
+    :param tiff: bytes of the TIFF structure
+    :param img_name: image path, for error messages
+    :return: EXIF orientation, None if missing
+    """
     try:
-        with exiftool.ExifTool() as et:
-            orientation = et.get_metadata(img_name)["EXIF:Orientation"]
-    except KeyError:
+        if tiff[:2] == b'II':
+            endian = '<'
+        elif tiff[:2] == b'MM':
+            endian = '>'
+        else:
+            raise ValueError('Unknown EXIF byte order in {}'.format(img_name))
+
+        magic, ifd_offset = struct.unpack(endian + 'HI', tiff[2:8])
+        if magic != 42:
+            raise ValueError('Malformed EXIF header in {}'.format(img_name))
+
+        entries = struct.unpack(endian + 'H', tiff[ifd_offset:ifd_offset + 2])[0]
+        for entry_idx in range(entries):
+            entry_offset = ifd_offset + 2 + 12 * entry_idx
+            tag, tag_type, count = struct.unpack(endian + 'HHI', tiff[entry_offset:entry_offset + 8])
+            if tag != ORIENTATION_TAG:
+                continue
+            # SHORT value, stored in the first bytes of the value field
+            if tag_type != 3 or count != 1:
+                raise ValueError('Unexpected Orientation tag format in {}'.format(img_name))
+            return struct.unpack(endian + 'H', tiff[entry_offset + 8:entry_offset + 10])[0]
+    except struct.error:
+        raise ValueError('Truncated EXIF data in {}'.format(img_name))
+
+    return None
+
+
+class OrientationService:
+    """
+    EXIF orientation lookup. JPEG files are parsed natively, any other file goes
+    through a single long-lived ExifTool process.
+    Orientations are memoized by (path, mtime), and whole directories can be
+    queried with one ExifTool call through prefetch.
+    """
+
+    def __init__(self, batch_size: int = 500):
+        self.batch_size = batch_size
+        self._et = None
+        self._pid = None
+        self._cache = {}
+
+    def _exiftool(self):
+        # Forked workers inherit the object but not the process: start their own
+        if self._et is None or self._pid != os.getpid():
+            self._et = exiftool.ExifTool()
+            self._et.start()
+            self._pid = os.getpid()
+        return self._et
+
+    @staticmethod
+    def _key(img_name):
+        try:
+            return os.path.abspath(img_name), os.path.getmtime(img_name)
+        except OSError:
+            return None
+
+    def prefetch(self, img_names):
+        """
+        Read the orientation of many files with one ExifTool call per batch
+        :param img_names: list of image paths
+        """
+        keys = []
+        for img_name in img_names:
+            key = self._key(img_name)
+            if key is None or key in self._cache:
+                continue
+            try:
+                self._cache[key] = read_jpeg_orientation(img_name)
+            except (ValueError, OSError):
+                # Fall back to ExifTool for the files we can not parse
+                keys.append(key)
+
+        for idx0 in range(0, len(keys), self.batch_size):
+            batch = keys[idx0:idx0 + self.batch_size]
+            metadata = self._exiftool().get_tags_batch(['EXIF:Orientation'], [path for path, _ in batch])
+            orientations = {data.get('SourceFile'): data.get('EXIF:Orientation') for data in metadata}
+            for key in batch:
+                self._cache[key] = orientations.get(key[0])
+
+    def orientation(self, img_name):
+        """
+        :param img_name: image path
+        :return: EXIF orientation, None if missing
+        """
+        key = self._key(img_name)
+        if key is None:
+            return None
+        if key not in self._cache:
+            self.prefetch([img_name])
+        return self._cache.get(key)
+
+    def close(self):
+        if self._et is not None and self._pid == os.getpid():
+            self._et.terminate()
+        self._et = None
+
+
+_orientation_service = OrientationService()
+atexit.register(_orientation_service.close)
+
+def get_orientation(img_name):
+    return _orientation_service.orientation(img_name)
+
+def prefetch_orientations(img_names):
+    _orientation_service.prefetch(img_names)
+
+def imread_aligned(img_name, flags=cv2.IMREAD_COLOR):
+    """
+    Read an image in the orientation of the sensor, as rotate_image(cv2.imread(img_name), img_name).
+    cv2.imread already applies the EXIF orientation, which rotate_image then undoes: decoding
+    with IMREAD_IGNORE_ORIENTATION gives the same pixels without rotating (and copying) twice.
+    :param img_name: image path
+    :param flags: cv2.imread flags
+    :return: image, None if it can not be read or its orientation is missing or not supported
+    """
+    orientation = get_orientation(img_name)
+    if orientation not in (1, 3, 6, 8):
+        return None
+    return cv2.imread(img_name, flags | cv2.IMREAD_IGNORE_ORIENTATION)
+
+def rotate_image(img, img_name):
+    orientation = get_orientation(img_name)
+    if orientation is None:
         return None
 
     if orientation == 8:
@@ -14,17 +189,15 @@ def rotate_image(img, img_name):
         img = cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
     if orientation == 3:
         img = cv2.rotate(img, cv2.ROTATE_180)
-        
+
     if orientation != 8 and orientation != 1 and orientation != 6 and orientation != 3:
         return None
 
     return img
 
 def rotate_back_image(img, img_name):
-    try:
-        with exiftool.ExifTool() as et:
-            orientation = et.get_metadata(img_name)["EXIF:Orientation"]
-    except KeyError:
+    orientation = get_orientation(img_name)
+    if orientation is None:
         return None
 
     if orientation == 8:
@@ -37,4 +210,4 @@ def rotate_back_image(img, img_name):
     if orientation != 8 and orientation != 1 and orientation != 6 and orientation != 3:
         return None
 
-    return img
\ No newline at end of file
+    return img
@@ -1,27 +1,69 @@
 import numpy as np
-from scipy.signal import convolve2d
+from utils.fft_backend import rfft2, irfft2, next_fast_len
 from typing import Any
-from multiprocessing import Pool
+import os
+
+CSF_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'csf.csv')
+
+# The CSF kernel is read once per process, its spectrum once per image shape
+_csf_kernel = None
+_csf_spectra = {}
+
+
+def csf_kernel() -> np.ndarray:
+    """
+    Load the 41x41 contrast sensitivity function kernel, caching it for the next calls
+    :return: 2D CSF kernel
+    """
+    global _csf_kernel
+    if _csf_kernel is None:
+        _csf_kernel = np.genfromtxt(CSF_PATH, delimiter=',')
+    return _csf_kernel
+
+
+def csf_spectrum(fft_shape: tuple) -> np.ndarray:
+    """
+    Real spectrum of the flipped CSF kernel, zero padded to fft_shape. Cached per shape
+    :param fft_shape: (height, width) of the FFT grid
+    :return: rfft2 of the kernel used by convolve_csf
+    """
+    spectrum = _csf_spectra.get(fft_shape)
+    if spectrum is None:
+        spectrum = rfft2(np.rot90(csf_kernel(), 2), s=fft_shape)
+        _csf_spectra[fft_shape] = spectrum
+    return spectrum
+
+
+def convolve_csf(channel: np.ndarray) -> np.ndarray:
+    """
+    Same as convolve2d(channel, np.rot90(w, 2), mode='valid') with w the CSF kernel, computed through the FFT
+    :param channel: 2D matrix
+    :return: 2D matrix of size (h - kh + 1, w - kw + 1)
+    """
+    h, w = channel.shape
+    kh, kw = csf_kernel().shape
+    fft_shape = (next_fast_len(h + kh - 1, real=True), next_fast_len(w + kw - 1, real=True))
+
+    full = irfft2(rfft2(channel, s=fft_shape) * csf_spectrum(fft_shape), s=fft_shape)
+
+    return full[kh - 1:h, kw - 1:w]
 
-def convolve_channel(args):
-    channel, w = args
-    return convolve2d(channel, np.rot90(w, 2), mode='valid')
 
 def wpsnr(img1: Any, img2: Any) -> float:
     img1 = np.float32(img1) / 255.0
     img2 = np.float32(img2) / 255.0
-    
+
     difference = img1 - img2
     same = not np.any(difference)
     if same:
         return 9999999
-    
-    w = np.genfromtxt('utils/csf.csv', delimiter=',')
-    
-    with Pool(processes=3) as pool:
-        ew_r, ew_g, ew_b = pool.map(convolve_channel, [(difference[:, :, i], w) for i in range(3)])
-    
-    ew = (ew_r + ew_g + ew_b) / 3.0
-    
+
+    # The convolution is linear, so the mean of the three filtered channels
+    # is the filtered mean of the channels: a single FFT convolution is enough
+    if difference.ndim == 3:
+        difference = difference.mean(axis=2, dtype=np.float64)
+
+    ew = convolve_csf(difference)
+
     decibels = 20.0 * np.log10(1.0 / np.sqrt(np.mean(ew ** 2)))
     return decibels